@@ -0,0 +1,415 @@
+#! /usr/bin/python3
+
+###################################################################################################################
+# Descripcion: Benchmark of silence-alerts.py against a fake Alertmanager
+#
+#              Each size runs in its own process: a cold run (every silence is created) and a warm run
+#              (every silence is a duplicate). The fake Alertmanager is pre-seeded with other silences
+#              and counts the calls it receives. The peak memory is the peak RSS of the process
+#
+# Departament: Innovation
+###################################################################################################################
+
+# Imports
+#------------------------------------------------------------------------------------------------------------------
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+import urllib.parse
+import uuid
+import yaml
+#------------------------------------------------------------------------------------------------------------------
+
+# Variables
+#------------------------------------------------------------------------------------------------------------------
+base_path     = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+script        = "{}/silence-alerts.py".format(base_path)
+
+sizes_default = [10, 1000, 10000]
+seed_default  = 5000
+
+# Fraction of second and zone of the dates of Alertmanager
+re_date_suffix = re.compile(r'(\.\d+)?(Z|[+-]\d{2}:\d{2})$')
+#------------------------------------------------------------------------------------------------------------------
+
+# Funciones
+#==================================================================================================================
+# Description: Silences of the fake Alertmanager, shared by the HTTP fake and the exec fake
+# Parameters:  None
+# Return:      Nothing
+
+class FakeSilences:
+   def __init__(self):
+      self.silences = {}
+      self.payload  = None
+      self.calls    = 0
+      self.lock     = threading.Lock()
+
+   # Like Alertmanager, a silence whose start is past starts now
+   def add(self, silence):
+      with self.lock:
+         now               = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+         silence           = dict(silence)
+         silence['id']     = silence.get('id') or str(uuid.uuid4())
+         silence['status'] = {'state': 'active'}
+
+         if re_date_suffix.sub('', silence['startsAt']) < now[:19]:
+            silence['startsAt'] = now
+
+         self.silences[silence['id']] = silence
+         self.payload                 = None
+
+         return silence['id']
+
+   def expire(self, silence_id):
+      with self.lock:
+         if not silence_id in self.silences:
+            raise ValueError("silence {} not found".format(silence_id))
+
+         self.silences[silence_id]['status'] = {'state': 'expired'}
+         self.payload                        = None
+
+   # The JSON of the silences is cached, so the cost of the fake is not measured as cost of the script
+   # The filters are matched as Alertmanager does, against the matchers of the silence as if they were labels
+   def dump(self, filters=()):
+      with self.lock:
+         if len(filters) > 0:
+            matchers = [parse_filter(f) for f in filters]
+
+            return json.dumps([s for s in self.silences.values()
+                               if all([m(dict([(x['name'], x['value']) for x in s['matchers']])) for m in matchers])])
+
+         if self.payload is None:
+            self.payload = json.dumps(list(self.silences.values()))
+
+         return self.payload
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a filter of the silences query
+# Parameters:  Filter in the syntax of the Alertmanager matchers
+# Return:      Function which checks a dict of labels
+
+def parse_filter(f):
+   m = re.match(r'^([^=~]+)(=~|=)"(.*)"$', f)
+
+   if m is None:
+      raise ValueError("bad filter: {}".format(f))
+
+   name  = m.group(1)
+   value = re.sub(r'\\(.)', r'\1', m.group(3))
+
+   if m.group(2) == '=':
+      return lambda labels: labels.get(name, '') == value
+
+   regex = re.compile('^(?:{})$'.format(value))
+
+   return lambda labels: regex.match(labels.get(name, '')) is not None
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Start an in-process fake of the Alertmanager API v2
+# Parameters:  Silences of the fake
+# Return:      URL of the fake
+
+def start_fake_http(store):
+   class Handler(BaseHTTPRequestHandler):
+      protocol_version        = 'HTTP/1.1'
+
+      # Headers and body are written apart, without this each keep-alive request waits for a delayed ACK
+      disable_nagle_algorithm = True
+
+      def log_message(self, format, *args):
+         pass
+
+      def reply(self, code, body):
+         body = body.encode('utf-8')
+
+         self.send_response(code)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_GET(self):
+         store.calls += 1
+         query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+         self.reply(200, store.dump(query.get('filter', [])))
+
+      def do_POST(self):
+         store.calls += 1
+         silence = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+         self.reply(200, json.dumps({'silenceID': store.add(silence)}))
+
+      def do_DELETE(self):
+         store.calls += 1
+         store.expire(self.path.rsplit('/', 1)[1])
+         self.reply(200, '')
+
+   server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+
+   return "http://127.0.0.1:{}".format(server.server_address[1])
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Exec backend which emulates amtool in process instead of running it inside a pod
+#              Each call to exec_command() is counted as one exec session
+# Parameters:  Script module and silences of the fake
+# Return:      The backend
+
+def fake_exec_backend(sa, store, batch):
+   class FakeAmtoolBackend(sa.AmtoolBackend):
+      def exec_command(self, cmd, script=None, stream_output=False, pod=None):
+         store.calls += 1
+
+         if stream_output:
+            # The exec session delivers the output in frames
+            output = fake_amtool(store, cmd)
+            return (output[i:i + 65536] for i in range(0, len(output), 65536))
+
+         if script is None:
+            # The command prints its exit code after its output
+            try:
+               return "{}@@end 0@@\n".format(fake_amtool(store, cmd[:-len(' 2>&1; echo "@@end $?@@"')]))
+            except ValueError as e:
+               return "{}\n@@end 1@@\n".format(e)
+
+         output = []
+         rc     = 0
+
+         for line in script.splitlines():
+            m = re.match(r'^echo "@@(begin|end) (\d+)( \$\?)?@@"$', line)
+
+            if m is not None:
+               output.append("@@{} {}{}@@\n".format(m.group(1), m.group(2), " {}".format(rc) if m.group(3) else ''))
+            elif line.startswith('amtool '):
+               try:
+                  output.append(fake_amtool(store, line[:-len(' 2>&1')]))
+                  rc = 0
+               except ValueError as e:
+                  output.append("{}\n".format(e))
+                  rc = 1
+
+         return ''.join(output)
+
+   return FakeAmtoolBackend('fake', sa.client.Configuration(), 'alertmanager', 'app=alertmanager', batch, 600)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Emulate an amtool silence command
+# Parameters:  Silences of the fake and command
+# Return:      Output of amtool
+
+def fake_amtool(store, cmd):
+   args = [a for a in shlex.split(cmd)[1:] if not a.startswith('--alertmanager.url')]
+
+   if args[:2] == ['silence', 'query']:
+      return store.dump([a for a in args[2:] if '=' in a and not a.startswith('-')])
+
+   if args[:2] == ['silence', 'expire']:
+      for silence_id in args[2:]:
+         store.expire(silence_id)
+      return ''
+
+   if args[:2] == ['silence', 'update']:
+      args    = [a for a in args if a != '--quiet']
+      silence = dict(store.silences[args[2]])
+      args    = args[:2] + args[3:]
+   elif args[:2] == ['silence', 'add']:
+      silence = {'matchers': []}
+   else:
+      raise ValueError("unknown command: {}".format(cmd))
+
+   for a in args[2:]:
+      if a.startswith('--'):
+         name, value = a[2:].split('=', 1)
+         silence[{'comment': 'comment', 'author': 'createdBy', 'start': 'startsAt', 'end': 'endsAt'}[name]] = value
+         continue
+
+      m = re.match(r'^([^=~]+)(=~|=)"(.*)"$', a)
+
+      if m is None:
+         raise ValueError("bad matcher: {}".format(a))
+
+      silence['matchers'].append({'name': m.group(1), 'value': m.group(3), 'isRegex': m.group(2) == '=~'})
+
+   return store.add(silence) + '\n'
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Write a config with a number of rules
+# Parameters:  Number of rules and path of the config
+# Return:      Nothing
+
+def make_conf(rules, path):
+   alerts = []
+   now    = datetime.utcnow()
+
+   # The windows are in progress, so their silences start in the past and the warm run checks that they are
+   # found as duplicates after Alertmanager moves their start
+   start  = (now - timedelta(hours=1)).strftime('%H:00:00')
+   end    = (now + timedelta(hours=2)).strftime('%H:00:00')
+
+   for i in range(rules):
+      alerts.append({'labels': [{'name': 'alertname', 'value': 'BenchAlert{}'.format(i), 'type': 'string'},
+                                {'name': 'instance',  'value': 'srv{}.+'.format(i),     'type': 'regex'}],
+                     'when':   {'everyDay': {'timeStart': start, 'timeEnd': end}}})
+
+   with open(path, 'w') as stream:
+      yaml.safe_dump({'global': {'comment': 'Benchmark', 'author': 'bench', 'timezone': 'UTC'}, 'alerts': alerts},
+                     stream)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Add silences which don't belong to the rules of the benchmark
+# Parameters:  Silences of the fake and number of silences
+# Return:      Nothing
+
+def seed(store, silences):
+   for i in range(silences):
+      store.add({'matchers':  [{'name': 'alertname', 'value': 'Other{}'.format(i), 'isRegex': False}],
+                 'startsAt':  '2019-01-01T00:00:00.000Z',
+                 'endsAt':    '2030-01-01T00:00:00.000Z',
+                 'createdBy': 'someone',
+                 'comment':   'Seeded'})
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Run the benchmark of one size in this process
+# Parameters:  Arguments of the command line
+# Return:      Nothing, the results are printed as JSON
+
+def child(args):
+   spec = importlib.util.spec_from_file_location('silence_alerts', script)
+   sa   = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(sa)
+   sa.import_clients()
+
+   store   = FakeSilences()
+   results = []
+
+   seed(store, args.seed)
+   store.dump()
+
+   with tempfile.TemporaryDirectory() as tmp:
+      sa.file_conf        = "{}/silence-alerts.yaml".format(tmp)
+      sa.am_backend       = args.backend
+      sa.alertmanager_url = start_fake_http(store) if args.backend == 'http' else None
+      sa.concurrency      = args.concurrency
+      sa.amtool_batch     = args.batch
+      sa.own_silences     = False
+      sa.target_timeout   = 600
+      sa.current_date     = datetime.now()
+
+      make_conf(args.child, sa.file_conf)
+
+      for run in ['cold', 'warm']:
+         calls = store.calls
+
+         start = timeit.default_timer()
+
+         sa.load_file_conf()
+         sa.compile_conf()
+
+         if args.backend == 'http':
+            sa.load_backends()
+         else:
+            sa.backends = [fake_exec_backend(sa, store, args.batch)]
+
+         sa.silence_alerts()
+
+         seconds = timeit.default_timer() - start
+
+         # Peak RSS of the process (KB in Linux), it includes the fake and the seeded silences
+         peak    = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+         results.append({'run': run, 'seconds': seconds, 'calls': store.calls - calls, 'peak': peak})
+
+   print(json.dumps(results))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Run the benchmark of each size in a new process and print the results
+# Parameters:  Arguments of the command line
+# Return:      Nothing, exit with error if a limit is exceeded
+
+def bench(args):
+   failed = False
+
+   print("{:<8} {:>6} {:>6} {:<5} {:>10} {:>7} {:>10} {:>9}".format(
+         'backend', 'rules', 'seed', 'run', 'seconds', 'calls', 'calls/rule', 'peak MB'))
+
+   for size in args.sizes:
+      cmd = [sys.executable, os.path.realpath(__file__), '--child', str(size), '--seed', str(args.seed),
+             '--backend', args.backend, '--concurrency', str(args.concurrency)]
+
+      if args.batch:
+         cmd.append('--batch')
+
+      res = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+      if res.returncode != 0:
+         print("[ERROR] Benchmark of {} rules failed".format(size))
+         sys.exit(1)
+
+      for r in json.loads(res.stdout.strip().splitlines()[-1]):
+         calls_per_rule = r['calls'] / size
+
+         print("{:<8} {:>6} {:>6} {:<5} {:>10.4f} {:>7} {:>10.3f} {:>9.1f}".format(
+               args.backend, size, args.seed, r['run'], r['seconds'], r['calls'], calls_per_rule,
+               r['peak'] / 1024 / 1024))
+
+         if args.max_calls_per_rule is not None and calls_per_rule > args.max_calls_per_rule:
+            print("[ERROR] {} calls per rule, the limit is {}".format(calls_per_rule, args.max_calls_per_rule))
+            failed = True
+
+         if args.max_seconds is not None and r['seconds'] > args.max_seconds:
+            print("[ERROR] {:0.4f} seconds, the limit is {}".format(r['seconds'], args.max_seconds))
+            failed = True
+
+   if failed:
+      sys.exit(1)
+#==================================================================================================================
+
+# Main
+#******************************************************************************************************************
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Benchmark of silence-alerts.py against a fake Alertmanager')
+
+   parser.add_argument('--sizes', type=int, nargs='+', default=sizes_default,
+                       help='Number of rules of each run (default 10 1000 10000)')
+   parser.add_argument('--seed', type=int, default=seed_default,
+                       help='Silences in the fake Alertmanager before the run (default 5000)')
+   parser.add_argument('--backend', choices=['http', 'exec'], default='http',
+                       help='http uses an in-process fake of the API v2, exec emulates amtool (default http)')
+   parser.add_argument('--concurrency', type=int, default=1,
+                       help='CONCURRENCY of the script (default 1)')
+   parser.add_argument('--batch', action='store_true',
+                       help='AMTOOL_BATCH of the script, only for the exec backend')
+   parser.add_argument('--max-calls-per-rule', type=float,
+                       help='Fail if a run makes more calls per rule')
+   parser.add_argument('--max-seconds', type=float,
+                       help='Fail if a run takes more seconds')
+   parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+
+   args = parser.parse_args()
+
+   if args.child is not None:
+      child(args)
+   else:
+      bench(args)
+#******************************************************************************************************************
@@ -0,0 +1,163 @@
+#! /usr/bin/python3
+
+###################################################################################################################
+# Descripcion: Regression checks of the daemon scheduling of silence-alerts.py
+#
+#              A rule with several windows must be scheduled window by window in order of start, whatever the
+#              type of each window, and a rule must start from its day in its timezone, whatever the timezone
+#              of the host. It exits with 1 if any check fails
+#
+# Departament: Innovation
+###################################################################################################################
+
+# Imports
+#------------------------------------------------------------------------------------------------------------------
+from datetime import datetime, timedelta
+
+import heapq
+import importlib.util
+import os
+import sys
+#------------------------------------------------------------------------------------------------------------------
+
+# Variables
+#------------------------------------------------------------------------------------------------------------------
+base_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+script    = "{}/silence-alerts.py".format(base_path)
+
+days      = 7
+
+# Timezones far from UTC, the day of one of them is always different from the day of the host
+timezones = ['Pacific/Pago_Pago', 'Pacific/Kiritimati', 'America/New_York', 'Asia/Tokyo']
+#------------------------------------------------------------------------------------------------------------------
+
+# Funciones
+#==================================================================================================================
+# Description: Compile one rule of the script
+# Parameters:  Script module, when clause and timezone of the rule
+# Return:      The rule
+
+def compile_rule(sa, when, timezone='Europe/Madrid'):
+   conf = {'global': {'author': 'check', 'comment': 'Check', 'timezone': timezone},
+           'alerts': [{'labels': [{'name': 'alertname', 'type': 'string', 'value': 'Check'}],
+                       'when':   when}]}
+
+   rules, errors = sa.compile_rules(conf)
+
+   if len(errors) > 0:
+      print("[ERROR] The rule of the check doesn't compile: {}".format(errors))
+      sys.exit(1)
+
+   return rules[0]
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Schedule a rule and pop its windows like the daemon does, each one schedules the next
+# Parameters:  Script module, rule and number of windows
+# Return:      List of the starts in UTC
+
+def scheduled_starts(sa, rule, count):
+   heap    = []
+   starts  = []
+
+   sa.schedule_rule(heap, rule)
+
+   while len(heap) > 0 and len(starts) < count:
+      due, position, start, day, rule, silence = heapq.heappop(heap)
+      starts.append(start)
+      sa.schedule_rule(heap, rule, day, after=start)
+
+   return starts
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: A fixed window in some days and a daily window are scheduled mixed in order of start
+# Parameters:  Script module
+# Return:      List of errors
+
+def check_fixed_and_daily(sa):
+   now   = datetime.utcnow()
+   today = datetime.now(sa.pytz.timezone('Europe/Madrid')).date()
+   fixed = today + timedelta(days=3)
+
+   rule = compile_rule(sa, {'windows': [
+             {'fixed':    {'dateStart': fixed.strftime('%d-%m-%Y'), 'timeStart': '15:00:00',
+                           'dateEnd':   fixed.strftime('%d-%m-%Y'), 'timeEnd':   '16:00:00'}},
+             {'everyDay': {'timeStart': '10:00:00', 'timeEnd': '11:00:00'}}]})
+
+   expected = [sa.local_to_utc(datetime.combine(fixed, datetime.min.time()).replace(hour=15), rule.timezone)]
+
+   for offset in range(days):
+      start = datetime.combine(today + timedelta(days=offset), datetime.min.time()).replace(hour=10)
+      start = sa.local_to_utc(start, rule.timezone)
+
+      if start + timedelta(hours=1) > now:
+         expected.append(start)
+
+   expected = sorted(expected)
+   starts   = scheduled_starts(sa, rule, len(expected))
+
+   if starts != expected:
+      return ["fixed and everyDay: expected {} got {}".format(expected, starts)]
+
+   return []
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: A daily window late in the day, overnight and early in the day is scheduled from the day of the
+#              rule in its timezone, the window in progress included
+# Parameters:  Script module and timezone of the rule
+# Return:      List of errors
+
+def check_timezone(sa, timezone):
+   errors = []
+   now    = datetime.utcnow()
+   zone   = sa.pytz.timezone(timezone)
+   today  = datetime.now(zone).date()
+
+   for time_start, hours in [(23, 1), (22, 9), (0, 2)]:
+      rule = compile_rule(sa, {'everyDay': {'timeStart': '{:02d}:00:00'.format(time_start),
+                                            'timeEnd':   '{:02d}:00:00'.format((time_start + hours) % 24)}},
+                          timezone)
+
+      expected = []
+
+      for offset in range(-1, days):
+         start = datetime.combine(today + timedelta(days=offset), datetime.min.time()).replace(hour=time_start)
+         end   = sa.local_to_utc(start + timedelta(hours=hours), zone)
+         start = sa.local_to_utc(start, zone)
+
+         if end > now:
+            expected.append(start)
+
+      starts = scheduled_starts(sa, rule, len(expected))
+
+      if starts != expected:
+         errors.append("everyDay {:02d}:00 {}: expected {} got {}".format(time_start, timezone, expected, starts))
+
+   return errors
+#==================================================================================================================
+
+# Main
+#******************************************************************************************************************
+if __name__ == '__main__':
+   spec = importlib.util.spec_from_file_location('silence_alerts', script)
+   sa   = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(sa)
+
+   # Settings of the daemon which are parsed in the main of the script
+   sa.daemon_lead_time = 0
+
+   errors = check_fixed_and_daily(sa)
+
+   for timezone in timezones:
+      errors.extend(check_timezone(sa, timezone))
+
+   for error in errors:
+      print("[ERROR] {}".format(error))
+
+   if len(errors) > 0:
+      sys.exit(1)
+
+   print("OK")
+#******************************************************************************************************************
@@ -8,26 +8,39 @@
 
 # Imports
 #------------------------------------------------------------------------------------------------------------------
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from kubernetes import client, config, stream
-from kubernetes.client.rest import ApiException
-from kubernetes.config import ConfigException
 from json.decoder import JSONDecodeError
 from time import process_time
-stream = stream.stream
 
+import argparse
+import codecs
+import contextlib
+import hashlib
+import heapq
 import os
 import sys
 import re
 import signal
+import sqlite3
 import yaml
 import subprocess
 import random
 import json
+import queue
+import shlex
+import threading
 import pytz
+import urllib.parse
 import atexit
+import time
 import timeit
+
+# The clients of Kubernetes and Alertmanager, the thread pool and the metrics server are imported by
+# import_clients(), so validate doesn't load them: client, config, stream, watch, ApiException, ConfigException,
+# websocket, WebSocketException, urllib3, ThreadPoolExecutor, as_completed, ThreadingHTTPServer and
+# BaseHTTPRequestHandler
 #------------------------------------------------------------------------------------------------------------------
 
 # Variables
@@ -37,11 +50,137 @@ process_init_time = timeit.default_timer()
 file_conf         = None
 default_file_conf = None
 conf              = {}
+conf_hash         = None
+
+# The config can be a file or a directory of yaml files, one per team. The files are parsed with the libyaml
+# loader when it is available, and each one keeps its parsed and compiled alerts while its content doesn't change
+conf_loader       = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+conf_extensions   = ('.yaml', '.yml')
+conf_parts        = ()
+parse_cache       = {}
+compile_cache     = {}
 
 
 k8s_conn_default  = 'in'
 k8s_instance      = None
 amtool            = 'amtool --alertmanager.url=http://localhost:9093'
+
+am_namespace      = 'alertmanager'
+am_pod_selector   = 'app=alertmanager'
+
+am_backend_default       = 'exec'
+alertmanager_url_default = 'http://alertmanager.alertmanager.svc:9093'
+http_pool_size           = 10
+http_timeout             = 10
+backends                 = []
+target_timeout_default   = 600
+
+concurrency_default      = 1
+amtool_batch_default     = 'false'
+
+# Exec calls: attempts in different pods, seconds of the jittered exponential backoff between them and
+# seconds of an exec session, from the connection until the end of its output. A silence query slower than
+# hedge_after seconds is also sent to other pod, the first answer wins (0 disables it)
+exec_retries_default     = 3
+exec_retries             = exec_retries_default
+exec_timeout_default     = 30
+exec_timeout             = exec_timeout_default
+retry_backoff            = 0.5
+retry_backoff_max        = 10
+hedge_after_default      = 0
+hedge_after              = 0
+
+# Silence ids per amtool silence expire command
+expire_chunk_size        = 500
+
+# The silences are queried filtered by the label common to all the rules. Too many values are split in
+# several queries of max length, more queries than the limit query all the silences
+filter_max_length        = 4000
+filter_max_queries       = 8
+own_silences_default     = 'false'
+own_silences             = False
+
+# The silences of the rules with the same author and matchers whose windows overlap or are adjacent are
+# merged in one silence with the comments of all of them
+merge_silences_default   = 'true'
+merge_enabled            = True
+merge_comment_separator  = ' / '
+
+# Optional SQLite state with the silences created or found by the script: (target, window) -> silence id
+# A run whose silences are all in the state doesn't query Alertmanager. The state is reconciled against
+# Alertmanager on a miss and every STATE_RECONCILE_INTERVAL seconds
+state_db                         = None
+state_conn                       = None
+state_lock                       = threading.Lock()
+state_reconcile_interval_default = 3600
+state_reconcile_interval         = state_reconcile_interval_default
+
+# Daemon mode: seconds before the window when the silence is created and max seconds asleep
+daemon_lead_time_default = 60
+daemon_max_sleep         = 60
+watch_interval           = 10
+
+# Metrics in the Prometheus text format: (name, labels) -> value. They are written to METRICS_TEXTFILE and
+# pushed to PUSHGATEWAY_URL at the exit, the daemon also serves them in /metrics
+metrics           = {}
+metrics_lock      = threading.Lock()
+metrics_textfile  = None
+pushgateway_url   = None
+metrics_job       = 'silence-alerts'
+metrics_help      = [('silence_alerts_phase_seconds',              'summary', 'Seconds spent in each phase'),
+                     ('silence_alerts_silences_total',             'counter', 'Silences of the rules by result'),
+                     ('silence_alerts_query_silences_total',       'counter', 'Silences received from Alertmanager'),
+                     ('silence_alerts_query_bytes_total',          'counter', 'Characters of the silence listings'),
+                     ('silence_alerts_state_lookups_total',        'counter', 'Runs checked against the local state'),
+                     ('silence_alerts_exec_retries_total',         'counter', 'Exec calls retried in other pod'),
+                     ('silence_alerts_hedged_queries_total',       'counter', 'Silence queries sent to a second pod'),
+                     ('silence_alerts_rules',                      'gauge',   'Rules compiled from the config'),
+                     ('silence_alerts_config_bytes',               'gauge',   'Size of the config'),
+                     ('silence_alerts_last_run_timestamp_seconds', 'gauge',   'Time of the last run')]
+
+# Timezone of the windows, it can be set in global.timezone and in each alert. Zones resolved: name -> zone
+timezone_default  = 'Europe/Madrid'
+timezones         = {}
+
+# Rules compiled from the alerts of the config
+rules             = ()
+when_directives   = ["everyDay", "everyMonday", "everyTuesday", 
+                     "everyWednesday", "everyThursday", "everyFriday", 
+                     "everySaturday", "everySunday", "fixed"]
+weekdays          = ['monday',   'tuesday', 'wednesday', 
+                     'thursday', 'friday',  'saturday', 'sunday']
+
+# Calendar windows: cron expressions, monthly patterns and days of the shared calendars. A rule can have
+# several windows of any type in a windows list
+calendar_directives = ["cron", "monthly", "holidays"]
+window_keys       = {'everyDay': ['timeStart', 'timeEnd', 'except', 'exceptCalendars'],
+                     'fixed':    ['dateStart', 'timeStart', 'dateEnd', 'timeEnd'],
+                     'cron':     ['expression', 'duration', 'exceptCalendars'],
+                     'monthly':  ['day', 'timeStart', 'timeEnd', 'exceptCalendars'],
+                     'holidays': ['calendar', 'timeStart', 'timeEnd', 'exceptCalendars']}
+nth_names         = ['first', 'second', 'third', 'fourth', 'fifth']
+cron_months       = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4,  'may': 5,  'jun': 6,
+                     'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+cron_weekdays     = {'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5, 'sat': 6}
+re_cron_part      = re.compile(r'^(\*|[a-z0-9]+(-[a-z0-9]+)?)(/(\d+))?$')
+re_monthly_day    = re.compile(r'^(first|second|third|fourth|fifth|last) (\w+)$')
+
+# Max days to look for the next window of a rule which isn't repeated every week
+schedule_horizon_days = 366
+
+# Windows of the rules for a range of days sorted by start, reused while the config doesn't change
+window_index_cache = None
+re_time           = re.compile(r'^(\d{1,2}):(\d{1,2}):(\d{1,2})$')
+re_day            = re.compile(r'^(\d{1,2})-(\d{1,2})-(\d{4})$')
+
+# Alertmanager uses the RE2 syntax of Go, which has no lookarounds, atomic groups nor backreferences that
+# Python accepts: (?=, (?!, (?<=, (?<!, (?>, (?P=name) and \1. An escaped backslash is not a backreference
+re_not_re2        = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?(?:<?[=!]|>|P=))')
+
+# Each backend has an index of its silences in Alertmanager: (startsAt, endsAt, matchers) -> silence id
+# the silences of the authors of the rules: (author, matchers) -> list of (silence id, startsAt, endsAt)
+# and the starts of the silences: (endsAt, matchers) -> list of (startsAt, silence id)
+re_date_suffix    = re.compile(r'(\.\d+)?(Z|[+-]\d{2}:\d{2})$')
 #------------------------------------------------------------------------------------------------------------------
 
 # Funciones
@@ -66,13 +205,49 @@ def signal_handler(sig, frame):
 
 #==================================================================================================================
 # Description: Main
-# Parameters:  None
+# Parameters:  Arguments of the command line
 # Return:      Nothing
 
-def main():
-   k8s_load_config() 
-   load_file_conf()
-   silence_alerts()
+def main(args):
+   try:
+      with phase_timer('config_load'):
+         load_file_conf()
+
+         # The gc expires the silences of all the alerts removed, even if there are no alerts left
+         compile_conf(allow_empty=(args.command == 'gc' or args.command == 'validate'))
+
+      # All the errors of the config have been reported by compile_conf()
+      if args.command == 'validate':
+         print("{}: {} alerts OK".format(file_conf, len(rules)))
+         return
+
+      # The plan doesn't talk to any Alertmanager
+      if args.command == 'plan':
+         plan(args.lookahead_days)
+         return
+
+      load_backends()
+
+      if state_db is not None:
+         open_state()
+
+      if args.command == 'gc':
+         gc(args.max_age, args.dry_run)
+      elif args.command == 'daemon':
+         if args.configmap is not None:
+            # The ConfigMap is watched through the Kubernetes API
+            if k8s_instance is None:
+               k8s_load_config()
+
+         if args.metrics_port is not None:
+            start_metrics_server(args.metrics_port)
+
+         daemon(args.watch, args.configmap, args.configmap_key)
+      else:
+         silence_alerts(getattr(args, 'lookahead_days', None))
+   except BackendError as e:
+      print("[ERROR] {}".format(e))
+      sys.exit(1)
 #==================================================================================================================
 
 #==================================================================================================================
@@ -88,509 +263,3221 @@ def load_file_conf():
       print("[ERROR] File \"{0}\" not found".format(file_conf))
       sys.exit(1)
 
-   with open(file_conf) as stream:
-      try:
-         conf = yaml.load(stream, Loader=yaml.FullLoader)
-      except yaml.YAMLError as ex:
-         print("[ERROR] {}".format(ex))
-         sys.exit(1)
+   global conf_hash
+   global conf_parts
+
+   try:
+      sources                     = read_conf_sources(file_conf)
+      conf, conf_parts, conf_hash = parse_conf(sources)
+   except ConfError as ex:
+      print("[ERROR] {}".format(ex))
+      sys.exit(1)
+
+   metric_set('silence_alerts_config_bytes', sum([len(content) for name, content in sources]))
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Make sanity checks and call make_silence() 
-# Parameters:  None
-# Return:      Nothing, if any issue exit the script
+# Description: Exception raised when the config can't be read or parsed
+# Parameters:  Message
+# Return:      Nothing
 
-def silence_alerts():
-   global conf
+class ConfError(Exception):
+   pass
+#==================================================================================================================
 
-   every_directive_exists = False
-   every_directives       = ["everyDay", "everyMonday", "everyTuesday", 
-                             "everyWednesday", "everyThursday", "everyFriday", 
-                             "everySaturday", "everySunday", "fixed"]
+#==================================================================================================================
+# Description: Get the files of the config: the file itself or the yaml files of a directory sorted by name
+#              The hidden entries are skipped, as the ..data directory of a ConfigMap mounted as a volume
+# Parameters:  Path of the config
+# Return:      List of paths, if any issue raise ConfError
 
-   if not 'alerts' in conf:
-      print("[ERROR] alerts section not found")
-      sys.exit(1)
+def conf_files(path):
+   if not os.path.isdir(path):
+      return [path]
 
-   if len(conf['alerts']) == 0:
-      #print("No alerts found")
-      sys.exit(0)
+   try:
+      names = sorted([n for n in os.listdir(path) if n.endswith(conf_extensions) and not n.startswith('.')])
+   except OSError as e:
+      raise ConfError("Reading directory {}: {}".format(path, e))
 
-   # Sanity checks
-   if not 'global' in conf:
-      print("[ERROR] global section not found")
-      sys.exit(1)
+   if len(names) == 0:
+      raise ConfError("No config files (*.yaml, *.yml) found in {}".format(path))
 
-   if 'comment' in conf['global']:
-      if len(conf['global']['comment']) == 0:
-         print("[ERROR] global.comment is empty")
-         sys.exit(1)
-   else:
-      print("[ERROR] global.comment directive not found")
-      sys.exit(1)
+   return [os.path.join(path, n) for n in names]
+#==================================================================================================================
 
-   if 'author' in conf['global']:
-      if len(conf['global']['author']) == 0:
-         print("[ERROR] global.author is empty")
-         sys.exit(1)
-   else:
-      print("[ERROR] global.author directive not found")
-      sys.exit(1)
+#==================================================================================================================
+# Description: Read the files of the config
+# Parameters:  Path of the config
+# Return:      List of (name, content), if any issue raise ConfError
 
-   for alert in conf['alerts']:
-      if not 'when' in alert:
-         print("[ERROR] when directive not found in alert")
-         sys.exit(1)
+def read_conf_sources(path):
+   sources = []
 
-      if not 'labels' in alert:
-         print("[ERROR] labels directive not found in alert")
-         sys.exit(1)
+   for name in conf_files(path):
+      try:
+         with open(name) as stream:
+            sources.append((name, stream.read()))
+      except OSError as e:
+         raise ConfError("Reading {}: {}".format(name, e))
 
-      for c in every_directives:
-         if c in alert['when']:
-            every_directive_exists = True
-            break
-            
-      if every_directive_exists:
-         every_directive_exists = False
-      else:
-         print("[ERROR] No directive every* or fixed found in when")
-         sys.exit(1)
+   return sources
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse the files of the config and merge them. The alerts and targets of the files are joined in
+#              order, the directives of global and the calendars can be defined only in one file
+# Parameters:  List of (name, content)
+# Return:      Tuple with the config, the parsed files (name, hash, data, lines) and the hash of the config
+#              If any issue raise ConfError
+
+def parse_conf(sources):
+   global parse_cache
+
+   parts       = [parse_conf_file(name, content) for name, content in sources]
+   parse_cache = {part[0]: part for part in parts}
+   conf_hash   = hashlib.sha256(repr([part[:2] for part in parts]).encode('utf-8')).hexdigest()
+
+   # A single file is used as it is
+   if len(parts) == 1:
+      return parts[0][2], tuple(parts), conf_hash
+
+   conf   = {}
+   owners = {}
+
+   for name, digest, data, lines in parts:
+      if data is None:
+         continue
+
+      if not isinstance(data, dict):
+         raise ConfError("{}: the config must be a dictionary".format(name))
+
+      for section, value in data.items():
+         if section == 'alerts' or section == 'targets':
+            if value is not None and not isinstance(value, list):
+               raise ConfError("{}: {} must be a list".format(name, section))
+
+            conf[section] = conf.get(section, []) + (value or [])
+         elif section == 'global' or section == 'calendars':
+            if not isinstance(value, dict):
+               raise ConfError("{}: {} must be a dictionary".format(name, section))
+
+            for key in value:
+               if (section, key) in owners:
+                  raise ConfError("{}: {}.{} already defined in {}".format(name, section, key, owners[(section, key)]))
+
+               conf.setdefault(section, {})[key] = value[key]
+               owners[(section, key)]             = name
+         elif section in conf:
+            raise ConfError("{}: {} already defined in {}".format(name, section, owners[(section,)]))
+         else:
+            conf[section]      = value
+            owners[(section,)] = name
+
+   return conf, tuple(parts), conf_hash
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a file of the config, unless it has the same content than in the last parse
+#              The line of the global section, of each calendar and of each alert are kept for the errors
+# Parameters:  Name and content of the file
+# Return:      Tuple (name, hash, data, lines), if any issue raise ConfError
+
+def parse_conf_file(name, content):
+   digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+   cached = parse_cache.get(name)
 
-      make_silence(alert)
+   if cached is not None and cached[1] == digest:
+      return cached
+
+   loader = conf_loader(content)
+   lines  = {'global': None, 'calendars': {}, 'alerts': []}
+
+   try:
+      node = loader.get_single_node()
+      data = loader.construct_document(node) if node is not None else None
+   except yaml.YAMLError as ex:
+      raise ConfError("{}: {}".format(name, ex))
+   finally:
+      loader.dispose()
+
+   if isinstance(node, yaml.MappingNode):
+      for key, value in node.value:
+         if key.value == 'global':
+            lines['global'] = key.start_mark.line + 1
+         elif key.value == 'calendars' and isinstance(value, yaml.MappingNode):
+            lines['calendars'] = {k.value: k.start_mark.line + 1 for k, v in value.value}
+         elif key.value == 'alerts' and isinstance(value, yaml.SequenceNode):
+            lines['alerts'] = [item.start_mark.line + 1 for item in value.value]
+
+   return (name, digest, data, lines)
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Sanity checks for dates
-# Parameters:  Alert
+# Description: Call make_silence() and create the silences
+# Parameters:  None
 # Return:      Nothing, if any issue exit the script
 
-def check_time(alert):
-   when_type = list(alert['when'])[0]
+def silence_alerts(lookahead_days=None):
+   with phase_timer('windows'):
+      silences, skipped = make_silences(lookahead_days)
+      silences, merged  = merge_silences(silences)
 
-   if not 'timeStart' in alert['when'][when_type] and not 'timeEnd' in alert['when'][when_type]:
-      print("[ERROR] timeStart or timeEnd not found")
-      sys.exit(1)
+   if len(merged) > 0:
+      print("Merged {} silences of rules with the same matchers".format(len(merged)))
 
-   if not re.match(r'^\d{1,2}:\d{1,2}:\d{1,2}$', alert['when'][when_type]['timeStart']):
-      print('[ERROR] Format timeStart incorrect: {}'.format(alert['when'][when_type]['timeStart']))
+   if apply_silences(silences, skipped, merged) > 0:
       sys.exit(1)
+#==================================================================================================================
 
-   if not re.match(r'^\d{1,2}:\d{1,2}:\d{1,2}$', alert['when'][when_type]['timeEnd']):
-      print('[ERROR] Format timeEnd incorrect: {}'.format(alert['when'][when_type]['timeEnd']))
-      sys.exit(1)
+#==================================================================================================================
+# Description: Merge the silences with the same author and matchers whose windows overlap or are adjacent
+#              The merged silence has the union of the windows and the comments of all of them
+# Parameters:  List of (rule, silence)
+# Return:      Tuple with the list of (rule, silence), where the rule is the first one of each merged silence,
+#              and the list of (rule, rule) with the rules whose silence was merged into the silence of other
 
-   if when_type == 'fixed':
-      # If it is fixed we also check dateStart and dateEnd
-      if not 'dateStart' in alert['when'][when_type] and not 'dateEnd' in alert['when'][when_type]:
-         print('[ERROR] dateStart or dateEnd not found')
-         sys.exit(1)
+def merge_silences(silences):
+   if not merge_enabled:
+      return silences, []
 
-      if not re.match(r'^\d{1,2}-\d{1,2}-\d{4}$', alert['when'][when_type]['dateStart']):
-         print('[ERROR] Format dateStart incorrect: {}'.format(alert['when'][when_type]['dateStart']))
-         sys.exit(1)
+   groups = {}
 
-      if not re.match(r'^\d{1,2}-\d{1,2}-\d{4}$', alert['when'][when_type]['dateEnd']):
-         print('[ERROR] Format dateEnd incorrect: {}'.format(alert['when'][when_type]['dateEnd']))
-         sys.exit(1)
-#==================================================================================================================
+   for rule, silence in silences:
+      groups.setdefault((silence['createdBy'], normalize_matchers(silence['matchers'])), []).append((rule, silence))
+
+   result = []
+   merged = []
+
+   for group in groups.values():
+      current = None
+
+      # The dates have the same format, so they are sorted as strings
+      for rule, silence in sorted(group, key=lambda i: (i[1]['startsAt'], i[0].position)):
+         if current is not None and silence['startsAt'] <= current[1]['endsAt']:
+            current[1]['endsAt'] = max(current[1]['endsAt'], silence['endsAt'])
 
+            if not silence['comment'] in current[2]:
+               current[2].append(silence['comment'])
+
+            merged.append((rule, current[0]))
+            continue
+
+         current = (rule, dict(silence), [silence['comment']])
+         result.append(current)
+
+   for rule, silence, comments in result:
+      if len(comments) > 1:
+         silence['comment'] = merge_comment_separator.join(["{}".format(c) for c in comments])
+
+   return sorted([(rule, silence) for rule, silence, comments in result],
+                 key=lambda i: (i[0].position, i[1]['startsAt'])), merged
 #==================================================================================================================
-# Description: Make the alert silence
-# Parameters:  Alert
-# Return:      Nothing, if any issue exit the script
 
-def make_silence(alert):
-   global current_date
-   global amtool
+#==================================================================================================================
+# Description: Make the silences of all the rules. By default the silence of today, with lookahead days the
+#              silences of the next days too, computed from the midnight of each day in the timezone of the
+#              rule like the daemon does. The windows already finished are not created. A rule can have several
+#              silences
+# Parameters:  Number of days or None
+# Return:      Tuple with the list of (rule, silence) and the list of rules without silences
 
-   when_type        = list(alert['when'])[0]
-   cmd              = ''
+def make_silences(lookahead_days=None):
+   silences = []
+   skipped  = []
 
-   time_start       = ''
-   time_end         = ''
+   # A run uses one clock, the date when it started
+   now      = current_date.astimezone(pytz.utc).replace(tzinfo=None)
 
-   date_start       = ''
-   date_end         = ''
+   if lookahead_days is None:
+      for rule in rules:
+         if rule.when_type in when_directives:
+            silence = make_silence(rule)
+            found   = [silence] if silence is not None else []
+         else:
+            # The calendar windows of today which haven't finished
+            today = current_date.astimezone(rule.timezone).date()
+            found = [window_silence(rule, s, e) for s, e in rule_windows(rule, today, 1) if e > now]
 
-   found_alertname  = False
+         if len(found) == 0:
+            skipped.append(rule)
 
-   # Check if today we have to silence the alert
-   if when_type == 'everyDay':
-      # We check exceptions
-      if 'except' in alert['when'][when_type]:
-         weekdays   = ['monday',   'tuesday', 'wednesday', 
-                       'thursday', 'friday',  'saturday', 'sunday']
-         weekday    = weekdays[current_date.weekday()]
-
-         for exc in alert['when'][when_type]['except']:
-            if weekday == exc.lower():
-               # Today is an exception, so we don't silence the alert
-               return
-   elif when_type == 'everyMonday':
-      if current_date.weekday() != 0:
-         return
-   elif when_type == 'everyTuesday':
-      if current_date.weekday() != 1:
-         return
-   elif when_type == 'everyWednesday':
-      if current_date.weekday() != 2:
-         return
-   elif when_type == 'everyThursday':
-      if current_date.weekday() != 3:
-         return
-   elif when_type == 'everyFriday':
-      if current_date.weekday() != 4:
-         return
-   elif when_type == 'everySaturday':
-      if current_date.weekday() != 5:
-         return
-   elif when_type == 'everySunday':
-      if current_date.weekday() != 6:
-         return
+         for silence in found:
+            silences.append((rule, silence))
 
-   # Sanity checks for time and date
-   check_time(alert)
+      return silences, skipped
 
-   cmd = amtool + ' silence add'
+   # The windows of the next days which haven't finished. Every window of the range is needed, the daemon
+   # finds the next window of each rule with its heap instead
+   found = {}
 
-   if 'comment' in alert:
-      cmd    = cmd + " --comment " + '\"' + alert['comment'] + '\"'
-   else:
-      cmd    = cmd + " --comment=" + '\"' + conf['global']['comment'] + '\"'
+   for start, end, rule in window_index(current_date, lookahead_days):
+      if end <= now:
+         continue
 
-   if 'author' in alert:
-      cmd    = cmd + " --author " + '\"' + alert['author'] + '\"'
-   else:
-      cmd    = cmd + " --author=" + '\"' + conf['global']['author'] + '\"'
+      found.setdefault(rule.position, []).append(window_silence(rule, start, end))
 
-   time_start = alert['when'][when_type]['timeStart']
-   time_end   = alert['when'][when_type]['timeEnd']
+   for rule in rules:
+      if not rule.position in found:
+         skipped.append(rule)
 
-   # If when type is fixed we also get the dateStart and dateEnd
-   if when_type == 'fixed':
-      date_start      = alert['when'][when_type]['dateStart']
-      date_end        = alert['when'][when_type]['dateEnd']
+      for silence in found.get(rule.position, []):
+         silences.append((rule, silence))
 
-      month_day_start = int(re.sub(r'^(\d{1,2})-\d{1,2}-\d{4}$', r'\1', date_start))
-      month_start     = int(re.sub(r'^\d{1,2}-(\d{1,2})-\d{4}$', r'\1', date_start))
-      year_start      = int(re.sub(r'^\d{1,2}-\d{1,2}-(\d{4})$', r'\1', date_start))
+   return silences, skipped
+#==================================================================================================================
 
-      month_day_end   = int(re.sub(r'^(\d{1,2})-\d{1,2}-\d{4}$', r'\1', date_end))
-      month_end       = int(re.sub(r'^\d{1,2}-(\d{1,2})-\d{4}$', r'\1', date_end))
-      year_end        = int(re.sub(r'^\d{1,2}-\d{1,2}-(\d{4})$', r'\1', date_end))
+#==================================================================================================================
+# Description: Print the silences which would be created today, without calling any backend
+# Parameters:  None
+# Return:      Nothing
 
+def plan(lookahead_days=None):
+   silences, skipped = make_silences(lookahead_days)
+   silences, merged  = merge_silences(silences)
 
-   # We get the start/end hour, min and second to create the command with the
-   # correct time
-   hour_start = int(re.sub(r'^(\d{1,2}):\d{1,2}:\d{1,2}$', r'\1', time_start))
-   min_start  = int(re.sub(r'^\d{1,2}:(\d{1,2}):\d{1,2}$', r'\1', time_start))
-   sec_start  = int(re.sub(r'^\d{1,2}:\d{1,2}:(\d{1,2})$', r'\1', time_start))
+   for rule, silence in silences:
+      print("{}\n   start:   {}\n   end:     {}\n   comment: {}\n   author:  {}".format(
+            rule.description, silence['startsAt'], silence['endsAt'], silence['comment'], silence['createdBy']))
 
-   hour_end   = int(re.sub(r'^(\d{1,2}):\d{1,2}:\d{1,2}$', r'\1', time_end))
-   min_end    = int(re.sub(r'^\d{1,2}:(\d{1,2}):\d{1,2}$', r'\1', time_end))
-   sec_end    = int(re.sub(r'^\d{1,2}:\d{1,2}:(\d{1,2})$', r'\1', time_end))
+   print("Silences: {}".format(len(silences)))
 
-   # Example date format for amtool: 2019-10-25T22:00:00-00:00
-   if when_type == 'fixed':
-      start = "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              year_start,month_start,month_day_start,
-              hour_start,min_start,sec_start)
-   else:
-      start = "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              current_date.year,current_date.month,current_date.day,
-              hour_start,min_start,sec_start)
-
-   if hour_start > hour_end:
-      # Hour start is greather than hour end, so the silence finishes in the next day
-      #
-      # We add a day to the current
-      finish_date = current_date + timedelta(days=1)
-   else:
-      finish_date = current_date
+   print("Skipped:  {}".format(len(skipped)))
+   for rule in skipped:
+      print("   {}".format(rule.description))
 
-   if when_type == 'fixed':
-      end = "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              year_end,month_end,month_day_end,
-              hour_end,min_end,sec_end)
-   else:
-      end = "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              finish_date.year,finish_date.month,finish_date.day,
-              hour_end,min_end,sec_end)
+   print("Merged:   {}".format(len(merged)))
+   for rule, into in merged:
+      print("   {} into #{}".format(rule.description, into.position + 1))
+#==================================================================================================================
 
-   # If the dates are old, add a day
-   if is_date_old(start):
-      start = add_day_to_date(start)
+#==================================================================================================================
+# Description: Expire in all the targets the silences created by the script (global.author) which don't
+#              belong to any alert of the config anymore or which started more than max age ago and no window
+#              of the alerts needs anymore
+#              Alertmanager can't delete the silences already expired, they are kept until its retention
+# Parameters:  Max age (timedelta or None) and True to only print the silences
+# Return:      Nothing, if any issue exit the script
 
-   if is_date_old(end):
-      end = add_day_to_date(end)
+def gc(max_age=None, dry_run=False):
+   author = (conf.get('global') or {}).get('author')
 
-   # Convert dates in UTC
-   # Notice: We convert the dates in UTC because Alertmanger uses UTC
-   start = convert_datetime_to_utc(start)
-   end   = convert_datetime_to_utc(end)
+   if author is None:
+      print("[ERROR] gc needs global.author to find the silences created by the script")
+      sys.exit(1)
 
-   # Add start and end time
-   cmd = cmd + " --start=" + start + " --end=" + end 
+   in_use = set([tuple(sorted(r.matchers)) for r in rules])
+   failed = 0
 
-   # Sanity checks for alertname label
-   # Notice: alertname is mandatory
-   for label in alert['labels']:
-      if 'alertname' in label['name']:
-         found_alertname = True
-         break
+   for backend in backends:
+      try:
+         failed += gc_backend(backend, author, in_use, max_age, dry_run)
+      except BackendError as e:
+         print("{}: [ERROR] {}".format(backend.name, e))
+         failed += 1
 
-   if not found_alertname:
-      print("[ERROR] alertname label not found")
+   if failed > 0:
       sys.exit(1)
+#==================================================================================================================
 
-   # Add the labels
-   for label in alert['labels']:
-      if not 'name' in label and not 'value' in label and not 'type' in label:
-         print("[ERROR] name, value or type not found in labels")
-         sys.exit(1)
-         
-      if label['type'] != 'string' and label['type'] != 'regex':
-         print("[ERROR] type unknown, only string or regex")
-         sys.exit(1)
+#==================================================================================================================
+# Description: Expire the silences of the gc in one target. All of them are expired with backend.expire_silences(),
+#              a single exec session in the exec backend
+# Parameters:  Backend, author, set of matchers in use, max age and True to only print the silences
+# Return:      Number of silences which couldn't be expired. If any issue raise BackendError
+
+def gc_backend(backend, author, in_use, max_age, dry_run):
+   oldest  = datetime.utcnow() - max_age if max_age is not None else None
+   garbage = []
+
+   # All the silences are queried, the ones to expire are the ones which don't match the rules
+   for s in backend.query_silences():
+      if s.get('createdBy') != author:
+         continue
+
+      matchers = normalize_matchers(s['matchers'])
+      start    = re_date_suffix.sub('', s['startsAt'])
+      end      = re_date_suffix.sub('', s['endsAt'])
+
+      # A silence of an alert is only too old if no window of the alerts still needs it
+      if not matchers in in_use:
+         reason = 'no alert'
+      elif oldest is not None and parse_date(start) < oldest and not silence_needed((author, matchers), start, end, []):
+         reason = 'too old'
+      else:
+         continue
 
-      if label['type'] == 'regex':
-         cmd = cmd + ' {}=~"{}"'.format(label['name'],label['value'])
+      garbage.append(s)
+
+      if dry_run:
+         matchers = ', '.join(['{}{}"{}"'.format(n, '=~' if r else '=', v) for n, v, r in normalize_matchers(s['matchers'])])
+
+         print("{}: {} {{{}}} {} - {} ({})".format(backend.name, s['id'], matchers, s['startsAt'], s['endsAt'], reason))
+
+   if dry_run:
+      print("{}: {} silences would be expired".format(backend.name, len(garbage)))
+      return 0
+
+   failed = 0
+
+   for s, res in zip(garbage, backend.expire_silences([s['id'] for s in garbage])):
+      if isinstance(res, BackendError):
+         print("{}: [ERROR] {}".format(backend.name, res))
+         failed += 1
       else:
-         cmd = cmd + ' {}="{}"'.format(label['name'],label['value'])
+         state_forget(backend, [s['id']])
 
-   # Before run the command we check if the silence is already created
-   if check_if_silence_already_exists(start, end, alert['labels']):
-      return
+   print("{}: Expired {} silences, failed {}".format(backend.name, len(garbage) - failed, failed))
 
-   # Run the command
-   exec_command(cmd)
+   return failed
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Run de alert command inside the pod
-# Parameters:  cmd
-# Return:      API response if OK, otherwise exit the script
+# Description: Create the silences in the targets. With one target the silences are created as always,
+#              with several targets they are created in all of them in parallel
+# Parameters:  List of (rule, silence), list of rules which don't have to be silenced today and list of rules
+#              merged into the silence of other
+# Return:      Number of failures. If any issue with one target raise BackendError
 
-def exec_command(cmd):
-   namespace = 'alertmanager'
-   stderr    = True 
-   stdin     = True 
-   stdout    = True 
-   tty       = True 
+def apply_silences(silences, skipped, merged=()):
+   metric_set('silence_alerts_last_run_timestamp_seconds', time.time())
 
-   # We get all alertmanager pods
-   ampods    = get_alertmanager_pods()
+   for backend in backends:
+      metric_inc('silence_alerts_silences_total', len(skipped), target=backend.name, result='skipped')
+      metric_inc('silence_alerts_silences_total', len(merged),  target=backend.name, result='merged')
 
-   # We choose a random pod
-   name      = ampods[random.randint(0, len(ampods) - 1)]
+   if len(backends) > 1:
+      return apply_silences_to_targets(silences)
 
-   try: 
-      api_response = stream(k8s_instance.connect_get_namespaced_pod_exec,
-                       name, namespace, command=['sh', '-c', cmd], stderr=stderr, stdin=stdin, 
-                       stdout=stdout, tty=tty)
-      return api_response
-   except ApiException as e:
-      print("[ERROR] Exception when calling CoreV1Api->connect_get_namespaced_pod_exec: {}".format(e))
-      sys.exit(1)
+   if concurrency > 1:
+      created, duplicates, failed = create_silences_concurrently(backends[0], silences)
+
+      print_report(created, duplicates, skipped, failed)
+
+      return len(failed)
+
+   create_silences(backends[0], silences)
+
+   return 0
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Get alertmanager pods
-# Parameters:  None
-# Return:      A list with the pods found. If any issue exit the script
+# Description: Create the silences in all the targets in parallel, each one with its own timeout
+#              The threads are daemon, so a target which doesn't answer doesn't block the exit
+# Parameters:  List of (rule, silence)
+# Return:      Number of targets failed
+
+def apply_silences_to_targets(silences):
+   results = {}
+   threads = []
+   started = time.monotonic()
+   failed  = 0
+
+   for backend in backends:
+      t = threading.Thread(target=apply_silences_to_target, args=(backend, silences, results), daemon=True)
+      t.start()
+      threads.append((backend, t))
+
+   for backend, t in threads:
+      t.join(max(0, started + backend.timeout - time.monotonic()))
+
+   for backend, t in threads:
+      if t.is_alive():
+         print("{}: [ERROR] timeout after {} seconds".format(backend.name, backend.timeout))
+         failed += 1
+      elif isinstance(results.get(backend.name), BackendError):
+         print("{}: [ERROR] {}".format(backend.name, results[backend.name]))
+         failed += 1
+      else:
+         created, duplicates, failed_rules = results[backend.name]
 
-def get_alertmanager_pods():
-   global k8s_instance
+         print("{}: created {}, duplicate {}, failed {}".format(
+               backend.name, len(created), len(duplicates), len(failed_rules)))
 
-   pods = []
-  
-   try:
-      ret = k8s_instance.list_namespaced_pod(namespace='alertmanager',watch=False)
+         for rule, e in failed_rules:
+            print("   {}: {}".format(rule.description, e))
 
-      for i in ret.items:
-         pods.append(i.metadata.name)
-   except ApiException as e:
-      print("[ERROR] Exception when calling CoreV1Api->list_namespaced_pod: {}".format(e))
-      sys.exit(1)
+         if len(failed_rules) > 0:
+            failed += 1
 
-   # Doble check
-   if len(pods) == 0:
-      print("[ERROR] Alertmanager Pods not found")
-      sys.exit(1)
+   return failed
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Create the silences in one target
+# Parameters:  Backend of the target, list of (rule, silence) and dict where the result is saved
+# Return:      Nothing. The result is the tuple (created, duplicates, failed) or the BackendError, an unexpected
+#              error is saved as a BackendError too, so it is reported as a failure of the target
+
+def apply_silences_to_target(backend, silences, results):
+   try:
+      if concurrency > 1:
+         results[backend.name] = create_silences_concurrently(backend, silences)
+      else:
+         results[backend.name] = create_silences(backend, silences)
+   except BackendError as e:
+      results[backend.name] = e
+   except Exception as e:
+      results[backend.name] = BackendError("Unexpected error: {}: {}".format(type(e).__name__, e))
+#==================================================================================================================
 
-   return pods 
 #==================================================================================================================
+# Description: Rule compiled from an alert of the config. The config is validated and compiled only once,
+#              after that the evaluation of the rules doesn't parse strings
+# Parameters:  None
+# Return:      Nothing
 
+class Rule:
+   __slots__ = ('position', 'when_type', 'windows', 'timezone', 'comment', 'author', 'matchers', 'description',
+                'fingerprint')
 #==================================================================================================================
-# Description: Compare if a date is old than the current
-# Parameters:  Date format
-# Return:      True if is old, False is not
 
-def is_date_old(string_date):
-   global current_date
+#==================================================================================================================
+# Description: Window of a rule compiled from a when directive. The times are local times of the timezone of
+#              the rule
+# Parameters:  Type of window (directive)
+# Return:      Nothing
 
-   string_date = string_date.replace('-00:00','')
-   d           = datetime.strptime(string_date, "%Y-%m-%dT%H:%M:%S")
+class Window:
+   __slots__ = ('kind', 'weekdays', 'time_start', 'time_end', 'date_start', 'date_end', 'cron', 'duration',
+                'monthday', 'nth', 'weekday', 'days', 'except_days')
 
-   if d < current_date:
-      return True
-   return False
+   def __init__(self, kind):
+      self.kind        = kind
+      self.weekdays    = 0b1111111
+      self.time_start  = None
+      self.time_end    = None
+      self.date_start  = None
+      self.date_end    = None
+      self.cron        = None
+      self.duration    = None
+      self.monthday    = None
+      self.nth         = None
+      self.weekday     = None
+      self.days        = frozenset()
+      self.except_days = frozenset()
+
+   # Content of the window, used by the fingerprint of the rule
+   def key(self):
+      return tuple([sorted(v) if isinstance(v, frozenset) else v for v in
+                    [getattr(self, name) for name in self.__slots__]])
+
+   # Check if a window (not cron) starts in a day
+   def matches(self, day):
+      if self.kind == 'holidays':
+         return day in self.days
+
+      if self.kind == 'monthly':
+         if self.monthday is not None:
+            return day.day == self.monthday or (self.monthday == -1 and (day + timedelta(days=1)).day == 1)
+
+         if day.weekday() != self.weekday:
+            return False
+
+         if self.nth == -1:
+            return (day + timedelta(days=7)).month != day.month
+
+         return (day.day - 1) // 7 + 1 == self.nth
+
+      return (self.weekdays >> day.weekday()) & 1 == 1
+
+   # Check if a cron expression matches a day. As in cron, if both day of month and day of week are
+   # restricted, the day matches if any of them matches
+   def cron_matches(self, day):
+      minutes, hours, monthdays, months, cron_weekdays, any_monthday, any_weekday = self.cron
+
+      if not day.month in months:
+         return False
+
+      monthday_ok = day.day in monthdays
+      weekday_ok  = (day.weekday() + 1) % 7 in cron_weekdays
+
+      if not any_monthday and not any_weekday:
+         return monthday_ok or weekday_ok
+
+      return monthday_ok and weekday_ok
+
+   # Local (start, end) of the windows (not fixed) which start in a day
+   def local_windows(self, day):
+      if day in self.except_days:
+         return []
+
+      if self.kind == 'cron':
+         if not self.cron_matches(day):
+            return []
+
+         return [(s, s + self.duration) for s in [datetime(day.year, day.month, day.day, h, m)
+                                                  for h in self.cron[1] for m in self.cron[0]]]
+
+      if not self.matches(day):
+         return []
+
+      start = datetime(*((day.year, day.month, day.day) + self.time_start))
+      end   = datetime(*((day.year, day.month, day.day) + self.time_end))
+
+      # Time start is greather than time end, so the silence finishes in the next day
+      if self.time_start > self.time_end:
+         end = end + timedelta(days=1)
+
+      return [(start, end)]
+
+   # Days from a day needed to find the next window
+   def horizon(self, day):
+      if self.kind == 'fixed':
+         return 1
+
+      if self.kind == 'holidays':
+         return max([1] + [(d - day).days + 1 for d in self.days])
+
+      if self.kind in calendar_directives:
+         return schedule_horizon_days
+
+      # A week, plus the days skipped by the calendars
+      return 8 + len(self.except_days)
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Load kubernetes config
+# Description: Validate the config and compile its alerts in rules
+#              All the errors are reported together
 # Parameters:  None
-# Return:      Nothing. If any issue exists the script
+# Return:      Nothing, if any issue exit the script
 
-def k8s_load_config():
-   global k8s_instance
+def compile_conf(allow_empty=False):
+   global rules
 
-   if k8s_conn == 'in':
-      try:
-         config.load_incluster_config()
-      except ConfigException as e:
-         print(
-            "[ERROR] Exception when calling kubernetes config->load_incluster_config: {}\n".format(e))
-         sys.exit(1)
-   else:
-      try:
-         config.load_kube_config()
-      except ConfigException as e:
-         print(
-            "[ERROR] Exception when calling kubernetes config->load_kube_config: {}".format(e))
-         sys.exit(1)
+   rules, errors = compile_rules(conf, conf_parts)
 
-   k8s_instance = client.CoreV1Api()
+   if len(errors) > 0:
+      for error in errors:
+         print("[ERROR] {}".format(error))
+      sys.exit(1)
+
+   metric_set('silence_alerts_rules', len(rules))
+
+   if len(rules) == 0 and not allow_empty:
+      #print("No alerts found")
+      sys.exit(0)
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Load kubernetes config
-# Parameters:  Date start, date end, comment, author and list of labels
-# Return:      True if exists, False otherwise. If any issue exists the script
+# Description: Validate a config and compile its alerts in rules
+#              The alerts of a file are compiled again only if the file, global, calendars or the position of
+#              its first alert have changed
+# Parameters:  Config and parsed files of the config (name, hash, data, lines), the errors show their file
+#              and line
+# Return:      Tuple with the rules and the list of errors
 
-def check_if_silence_already_exists(start, end, labels):
-   labels_orig = []
-   labels_dest = []
+def compile_rules(conf, parts=()):
+   global compile_cache
 
-   start       = start.replace('-00:00','')
-   end         = end.replace('-00:00','')
+   errors = []
 
-   # Create list labels orig
-   for l in labels:
-      labels_orig.append({"name": "{}".format(l['name']), "value": "{}".format(l['value'])})
+   if not isinstance(conf, dict) or not 'alerts' in conf:
+      return (), ["alerts section not found"]
 
-   # We build the command to query if alert already exists
-   cmd = amtool + ' silence query -o json'
+   if conf['alerts'] is not None and not isinstance(conf['alerts'], list):
+      return (), ["alerts must be a list"]
 
-   # Run the command
-   json_res = exec_command(cmd)
+   if conf['alerts'] is None or len(conf['alerts']) == 0:
+      return (), []
 
-   # Replace sigle for doble quote
-   json_res = json_res.replace("'",'"')
+   # Sanity checks
+   if not 'global' in conf or not isinstance(conf['global'], dict):
+      return (), ["global section not found"]
 
-   # Replace False for "False"
-   json_res = json_res.replace("False",'"False"')
+   # Without files (the config is not read from disk) all the alerts are compiled together
+   if len(parts) == 0:
+      parts = [(None, None, conf, None)]
 
-   # Replace True for "True"
-   json_res = json_res.replace("True",'"True"')
+   sources = ["{}:{}: ".format(name, lines['global']) for name, digest, data, lines in parts
+              if lines is not None and lines['global'] is not None]
+   where   = sources[0] if len(sources) == 1 else ''
 
-   # Convert string to dict
-   try:
-      res = json.loads(json_res)
-   except JSONDecodeError as e:
-      print( "[ERROR] Exception json.loads: {}".format(e))
-      sys.exit(1)
+   for directive in ['comment', 'author']:
+      if not directive in conf['global']:
+         errors.append("{}global.{} directive not found".format(where, directive))
+      elif conf['global'][directive] is None or conf['global'][directive] == '':
+         errors.append("{}global.{} is empty".format(where, directive))
+      elif not isinstance(conf['global'][directive], str):
+         errors.append("{}global.{} must be a string: {}".format(where, directive, conf['global'][directive]))
 
-   for j in res:
-      start_got   = "{}".format(j['startsAt'])
-      end_got     = "{}".format(j['endsAt'])
+   if get_timezone(conf['global'].get('timezone', timezone_default)) is None:
+      errors.append("{}global.timezone unknown: {}".format(where, conf['global'].get('timezone')))
 
-      start_got   = re.sub(r'\.\d{3}\w$', '', start_got)
-      end_got     = re.sub(r'\.\d{3}\w$', '', end_got)
+   calendar_sources = {k: "{}:{}".format(name, line) for name, digest, data, lines in parts if lines is not None
+                       for k, line in lines['calendars'].items()}
+   calendars        = compile_calendars(conf.get('calendars'), errors, calendar_sources)
 
-      # Check if is the same values
-      if start == start_got and end == end_got:
-         # Dates are the same, we check the labels
-         for l in j['matchers']:
-            labels_dest.append({"name": "{}".format(l['name']), "value": "{}".format(l['value'])})
+   # The compiled alerts of a file depend on the global section and the calendars too
+   context  = hashlib.sha256(repr((conf['global'], conf.get('calendars'))).encode('utf-8')).hexdigest()
+   cache    = {}
+   compiled = []
+   position = 0
 
-         if labels_orig == labels_dest:
-            # This silence is already created
-            return True
-            
-   return False
+   for name, digest, data, lines in parts:
+      alerts = (data or {}).get('alerts') or []
+      key    = (name, digest, context, position)
+
+      if digest is None or not key in compile_cache:
+         part_rules  = []
+         part_errors = []
+
+         for i, alert in enumerate(alerts):
+            source = None
+
+            if lines is not None and i < len(lines['alerts']):
+               source = "{}:{}".format(name, lines['alerts'][i])
+
+            rule = compile_rule(position + i, alert, conf['global'], calendars, part_errors, source)
+
+            if rule is not None:
+               part_rules.append(rule)
+
+         compile_cache[key] = (tuple(part_rules), part_errors)
+
+      cache[key] = compile_cache[key]
+
+      compiled.extend(cache[key][0])
+      errors.extend(cache[key][1])
+      position += len(alerts)
+
+   # Only the files of this config are kept
+   compile_cache = cache
+
+   return tuple(compiled), errors
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Add a day to the date passed as a parameter
-# Parameters:  String with the date
-# Return:      New date
+# Description: Compile the shared calendars of the config: name -> list of dates (DD-MM-YYYY)
+# Parameters:  calendars section, list of errors and file:line of each calendar
+# Return:      Dict name -> frozenset of dates
+
+def compile_calendars(calendars, errors, sources={}):
+   compiled = {}
+
+   if calendars is None:
+      return compiled
+
+   if not isinstance(calendars, dict):
+      errors.append("calendars must be a dictionary of lists of dates")
+      return compiled
+
+   for name, days in calendars.items():
+      where = "calendar {}".format(name)
+
+      if name in sources:
+         where = "{}: {}".format(sources[name], where)
+
+      if not isinstance(days, list):
+         errors.append("{}: must be a list of dates (DD-MM-YYYY)".format(where))
+         continue
 
-def add_day_to_date(string_date):
-   string_date = string_date.replace('-00:00','')
-   d           = datetime.strptime(string_date, "%Y-%m-%dT%H:%M:%S")
+      parsed = [parse_day({'date': d}, 'date', where, errors) for d in days]
 
-   # Add a day
-   d           = d + timedelta(days=1)
+      compiled[name] = frozenset([date(*d) for d in parsed if d is not None])
 
-   # Return string with the correct format
-   return "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              d.year, d.month, d.day, d.hour, d.minute, d.second)
+   return compiled
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Convert datetime to UTC
-# Parameters:  String with the date
-# Return:      New date
+# Description: Validate an alert and compile it
+# Parameters:  Position of the alert in the config, alert, global section, calendars, list where the errors
+#              are added and file:line of the alert
+# Return:      Rule, None if the alert has errors
+
+def compile_rule(position, alert, global_conf, calendars, errors, source=None):
+   rule     = Rule()
+   where    = "alert #{}".format(position + 1)
+
+   if source is not None:
+      where = "{}: {}".format(source, where)
+   n_errors = len(errors)
+
+   if not isinstance(alert, dict):
+      errors.append("{}: alert must be a dictionary".format(where))
+      return None
+
+   if not 'when' in alert or not isinstance(alert['when'], dict) or len(alert['when']) == 0:
+      errors.append("{}: when directive not found in alert".format(where))
+   elif not list(alert['when'])[0] in when_directives + calendar_directives + ['windows']:
+      errors.append("{}: No directive every*, fixed, cron, monthly, holidays or windows found in when".format(where))
+   elif len(alert['when']) > 1:
+      errors.append("{}: when must have only one directive: {}".format(where, ', '.join(map(str, alert['when']))))
+   else:
+      compile_when(rule, alert['when'], where, calendars, errors)
+
+   if not 'labels' in alert or not isinstance(alert['labels'], list):
+      errors.append("{}: labels directive not found in alert".format(where))
+   else:
+      compile_labels(rule, alert['labels'], where, errors)
+
+   for directive in ['comment', 'author']:
+      if directive in alert and not isinstance(alert[directive], str):
+         errors.append("{}: {} must be a string: {}".format(where, directive, alert[directive]))
+
+   # The timezone of the times and dates of the window
+   rule.timezone = get_timezone(alert.get('timezone', global_conf.get('timezone', timezone_default)))
+
+   if rule.timezone is None and 'timezone' in alert:
+      errors.append("{}: timezone unknown: {}".format(where, alert['timezone']))
+
+   # Without timezone the error is in global.timezone
+   if len(errors) > n_errors or rule.timezone is None:
+      return None
 
-def convert_datetime_to_utc(string_date):
-   local_tz    = pytz.timezone ("Europe/Madrid")
+   rule.position    = position
+   rule.comment     = alert['comment'] if 'comment' in alert else global_conf.get('comment')
+   rule.author      = alert['author']  if 'author'  in alert else global_conf.get('author')
+   rule.description = "#{} {{{}}}".format(position + 1, ', '.join(
+                      ['{}{}"{}"'.format(n, '=~' if r else '=', v) for n, v, r in rule.matchers]))
 
-   string_date = string_date.replace('-00:00','')
-   d           = datetime.strptime(string_date, "%Y-%m-%dT%H:%M:%S")
-   d           = local_tz.localize(d, is_dst=None)
-   d           = d.astimezone(pytz.utc)
+   # The fingerprint identifies the rule by its content, not by its position in the config
+   rule.fingerprint = hashlib.sha256(repr((
+                      rule.when_type, tuple([w.key() for w in rule.windows]), rule.timezone.zone, rule.comment,
+                      rule.author, tuple(sorted(rule.matchers)))).encode('utf-8')).hexdigest()
 
-   # Return string with the correct format
-   return "{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}-00:00".format(
-              d.year, d.month, d.day, d.hour, d.minute, d.second)
+   return rule
 #==================================================================================================================
 
 #==================================================================================================================
-# Description: Print process duration
-# Parameters:  None
+# Description: Compile the when directive of an alert: one window or a list of windows
+# Parameters:  Rule, when directive, position of the alert for the errors, calendars and list of errors
 # Return:      Nothing
 
-def print_duration():
-   print("Duration: {:0.4f} seconds".format(timeit.default_timer() - process_init_time))
+def compile_when(rule, when, where, calendars, errors):
+   when_type      = list(when)[0]
+   rule.when_type = when_type
+   rule.windows   = ()
+
+   if when_type != 'windows':
+      rule.windows = (compile_window(when_type, when[when_type], where, calendars, errors),)
+      return
+
+   if not isinstance(when['windows'], list) or len(when['windows']) == 0:
+      errors.append("{}: windows must be a list of when directives".format(where))
+      return
+
+   windows = []
+
+   for i, item in enumerate(when['windows']):
+      item_where = "{} window #{}".format(where, i + 1)
+
+      if not isinstance(item, dict) or len(item) == 0 or not list(item)[0] in when_directives + calendar_directives:
+         errors.append("{}: No directive every*, fixed, cron, monthly or holidays found".format(item_where))
+         continue
+
+      if len(item) > 1:
+         errors.append("{}: A window must have only one directive: {}".format(item_where, ', '.join(map(str, item))))
+         continue
+
+      windows.append(compile_window(list(item)[0], item[list(item)[0]], item_where, calendars, errors))
+
+   rule.windows = tuple(windows)
 #==================================================================================================================
 
-# Main
-#******************************************************************************************************************
-if __name__ == '__main__':
-   # Capture signals
-   signal.signal(signal.SIGTERM, signal_handler)
-   signal.signal(signal.SIGINT,  signal_handler)
+#==================================================================================================================
+# Description: Compile a window of a when directive
+# Parameters:  Type of window, window, position of the alert for the errors, calendars and list of errors
+# Return:      Window
 
-   # Register the function which print the duration of the process
-   atexit.register(print_duration)
+def compile_window(when_type, window, where, calendars, errors):
+   compiled = Window(when_type)
 
-   file_conf = os.environ.get('FILE_CONF')
-   k8s_conn  = os.environ.get('K8S_CONNECTION', k8s_conn_default)
+   if not isinstance(window, dict):
+      errors.append("{}: timeStart or timeEnd not found".format(where))
+      return compiled
 
-   base_path = os.path.dirname( os.path.realpath(__file__) )
-   base_path = base_path.replace('/scripts','')
+   # A misspelled key would be ignored silently
+   allowed = window_keys.get(when_type, ['timeStart', 'timeEnd', 'exceptCalendars'])
+   unknown = [key for key in window if not key in allowed]
 
-   default_file_conf = "{}/conf/silence-alerts.yaml".format(base_path)
+   if len(unknown) > 0:
+      errors.append("{}: Unknown keys in {}: {}".format(where, when_type, ', '.join(map(str, unknown))))
 
-   if file_conf == None:
-      file_conf = default_file_conf
+   # A string would be iterated letter by letter
+   not_lists = [key for key in ['except', 'exceptCalendars']
+                if window.get(key) is not None and not isinstance(window[key], list)]
 
-   if k8s_conn != 'in' and k8s_conn != 'out':
-      print("[ERROR] Kubernetes connection unknown: {}".format(k8s_conn))
+   for key in not_lists:
+      errors.append("{}: {} must be a list: {}".format(where, key, window[key]))
+
+   if len(not_lists) > 0:
+      return compiled
+
+   # Bitmask of the weekdays when the alert is silenced, bit 0 is monday
+   if when_type == 'everyDay':
+      for exc in window.get('except') or []:
+         if not "{}".format(exc).lower() in weekdays:
+            errors.append("{}: Unknown day in except: {}".format(where, exc))
+         else:
+            compiled.weekdays &= ~(1 << weekdays.index("{}".format(exc).lower()))
+   elif when_type.startswith('every'):
+      compiled.weekdays = 1 << weekdays.index(when_type[len('every'):].lower())
+
+   if when_type == 'cron':
+      compiled.cron     = parse_cron(window, where, errors)
+      compiled.duration = parse_timedelta(window.get('duration'))
+
+      if compiled.duration is None or compiled.duration.total_seconds() == 0:
+         errors.append("{}: Format duration incorrect (30m, 12h, 1d12h): {}".format(where, window.get('duration')))
+   else:
+      compiled.time_start = parse_time(window, 'timeStart', where, errors)
+      compiled.time_end   = parse_time(window, 'timeEnd',   where, errors)
+
+   # If it is fixed we also get dateStart and dateEnd
+   if when_type == 'fixed':
+      compiled.date_start = parse_day(window, 'dateStart', where, errors)
+      compiled.date_end   = parse_day(window, 'dateEnd',   where, errors)
+
+      # Alertmanager rejects a silence which ends before it starts
+      if not None in (compiled.date_start, compiled.time_start, compiled.date_end, compiled.time_end) and \
+         compiled.date_start + compiled.time_start >= compiled.date_end + compiled.time_end:
+         errors.append("{}: dateStart and timeStart must be before dateEnd and timeEnd".format(where))
+
+      return compiled
+
+   if when_type == 'monthly':
+      parse_monthly_day(compiled, window, where, errors)
+
+   if when_type == 'holidays':
+      if not isinstance(window.get('calendar'), str) or not window['calendar'] in calendars:
+         errors.append("{}: Calendar not found: {}".format(where, window.get('calendar')))
+      else:
+         compiled.days = calendars[window['calendar']]
+
+   # The days of the calendars are skipped
+   except_days = set()
+
+   for name in window.get('exceptCalendars') or []:
+      if not isinstance(name, str) or not name in calendars:
+         errors.append("{}: Calendar not found in exceptCalendars: {}".format(where, name))
+      else:
+         except_days.update(calendars[name])
+
+   compiled.except_days = frozenset(except_days)
+
+   return compiled
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse the day of a monthly window: a day of the month (1-31), last, or the nth weekday of the
+#              month (first sunday, last friday...)
+# Parameters:  Window compiled, window, position of the alert for the errors and list of errors
+# Return:      Nothing
+
+def parse_monthly_day(compiled, window, where, errors):
+   day = "{}".format(window.get('day')).lower()
+   m   = re_monthly_day.match(day)
+
+   if day.isdigit() and 1 <= int(day) <= 31:
+      compiled.monthday = int(day)
+   elif day == 'last':
+      compiled.monthday = -1
+   elif m is not None and m.group(2) in weekdays:
+      compiled.nth     = -1 if m.group(1) == 'last' else nth_names.index(m.group(1)) + 1
+      compiled.weekday = weekdays.index(m.group(2))
+   else:
+      errors.append("{}: Format day incorrect (15, last, first sunday...): {}".format(where, window.get('day')))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse the cron expression of a window: minute hour day-of-month month day-of-week
+# Parameters:  Window, position of the alert for the errors and list of errors
+# Return:      Tuple (minutes, hours, days of month, months, days of week, any day of month, any day of week),
+#              None if the expression is not valid
+
+def parse_cron(window, where, errors):
+   fields = "{}".format(window.get('expression')).lower().split()
+
+   if len(fields) == 5:
+      minutes   = parse_cron_field(fields[0], 0, 59, {})
+      hours     = parse_cron_field(fields[1], 0, 23, {})
+      monthdays = parse_cron_field(fields[2], 1, 31, {})
+      months    = parse_cron_field(fields[3], 1, 12, cron_months)
+      days      = parse_cron_field(fields[4], 0, 7,  cron_weekdays)
+
+      if not None in [minutes, hours, monthdays, months, days]:
+         # Sunday is 0 or 7
+         return (minutes, hours, frozenset(monthdays), frozenset(months), frozenset([d % 7 for d in days]),
+                 fields[2] == '*', fields[4] == '*')
+
+   errors.append("{}: Format expression incorrect: {}".format(where, window.get('expression')))
+
+   return None
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a field of a cron expression: *, values, ranges, steps and lists of them
+# Parameters:  Field, min value, max value and names of the values
+# Return:      Sorted tuple of values, None if the field is not valid
+
+def parse_cron_field(field, low, high, names):
+   values = set()
+
+   for part in field.split(','):
+      m = re_cron_part.match(part)
+
+      if m is None:
+         return None
+
+      step = int(m.group(4)) if m.group(4) is not None else 1
+
+      if m.group(1) == '*':
+         first, last = low, high
+      else:
+         bounds = ["{}".format(names.get(b, b)) for b in m.group(1).split('-')]
+
+         if not all([b.isdigit() for b in bounds]):
+            return None
+
+         first = int(bounds[0])
+         last  = int(bounds[-1]) if len(bounds) > 1 else (high if m.group(4) is not None else first)
+
+      if first < low or last > high or first > last or step == 0:
+         return None
+
+      values.update(range(first, last + 1, step))
+
+   return tuple(sorted(values))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Compile the labels of an alert in matchers
+# Parameters:  Rule, labels, position of the alert for the errors and list of errors
+# Return:      Nothing
+
+def compile_labels(rule, labels, where, errors):
+   matchers        = []
+   found_alertname = False
+
+   for label in labels:
+      if not isinstance(label, dict) or not 'name' in label or not 'value' in label or not 'type' in label:
+         errors.append("{}: name, value or type not found in labels".format(where))
+         continue
+
+
+      # Notice: alertname is mandatory, an error in its value is reported on its own
+      if label['name'] == 'alertname':
+         found_alertname = True
+
+      if not isinstance(label['name'], str) or isinstance(label['value'], (dict, list)):
+         errors.append("{}: name and value of a label must be strings: {}".format(where, label['name']))
+         continue
+
+      if label['type'] != 'string' and label['type'] != 'regex':
+         errors.append("{}: type unknown, only string or regex: {}".format(where, label['type']))
+         continue
+
+      # Alertmanager anchors the regex, a value which doesn't compile would be rejected when the silence is added
+      if label['type'] == 'regex':
+         try:
+            re.compile("{}".format(label['value']))
+         except re.error as e:
+            errors.append("{}: regex of label {} doesn't compile: {}".format(where, label['name'], e))
+            continue
+
+         if re_not_re2.search("{}".format(label['value'])):
+            errors.append("{}: regex of label {} uses lookarounds, atomic groups or backreferences, not "
+                          "supported by Alertmanager (RE2): {}".format(where, label['name'], label['value']))
+            continue
+
+      matchers.append(("{}".format(label['name']), "{}".format(label['value']), label['type'] == 'regex'))
+
+   if not found_alertname:
+      errors.append("{}: alertname label not found".format(where))
+
+   rule.matchers = tuple(matchers)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a time (HH:MM:SS) of a when directive
+# Parameters:  Window, name of the directive, position of the alert for the errors and list of errors
+# Return:      Tuple (hour, minute, second), None if the time is not valid
+
+def parse_time(window, name, where, errors):
+   if not name in window:
+      errors.append("{}: {} not found".format(where, name))
+      return None
+
+   m = re_time.match("{}".format(window[name]))
+
+   if m is None or int(m.group(1)) > 23 or int(m.group(2)) > 59 or int(m.group(3)) > 59:
+      errors.append("{}: Format {} incorrect: {}".format(where, name, window[name]))
+      return None
+
+   return (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a date (DD-MM-YYYY) of a when directive
+# Parameters:  Window, name of the directive, position of the alert for the errors and list of errors
+# Return:      Tuple (year, month, day), None if the date is not valid
+
+def parse_day(window, name, where, errors):
+   if not name in window:
+      errors.append("{}: {} not found".format(where, name))
+      return None
+
+   m = re_day.match("{}".format(window[name]))
+
+   try:
+      if m is None:
+         raise ValueError
+      datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+   except ValueError:
+      errors.append("{}: Format {} incorrect: {}".format(where, name, window[name]))
+      return None
+
+   return (int(m.group(3)), int(m.group(2)), int(m.group(1)))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Daemon mode. The config, the backend and the windows of the alerts are kept in memory and
+#              each silence is created just before its window starts
+# Parameters:  None
+# Return:      Nothing, runs until a signal is received
+
+def daemon(watch_file=False, watch_configmap=None, configmap_key=None):
+   # Heap with the next window of each rule: (due, position, start, day, rule, silence)
+   heap    = []
+
+   # New contents of the config sent by the watchers
+   updates = queue.Queue()
+
+   for rule in rules:
+      schedule_rule(heap, rule)
+
+   if watch_file:
+      threading.Thread(target=watch_conf_file, args=(updates,), daemon=True).start()
+
+   if watch_configmap is not None:
+      threading.Thread(target=watch_conf_configmap, args=(updates, watch_configmap, configmap_key),
+                       daemon=True).start()
+
+   watching = watch_file or watch_configmap is not None
+
+   print("Daemon started with {} scheduled alerts".format(len(heap)))
+
+   while len(heap) > 0 or watching:
+      if len(heap) > 0:
+         wait = (heap[0][0] - datetime.utcnow()).total_seconds()
+      else:
+         wait = daemon_max_sleep
+
+      if wait > 0:
+         # We wake up from time to time, so a clock change doesn't delay the silences
+         try:
+            reload_conf(heap, updates.get(timeout=min(wait, daemon_max_sleep)))
+         except queue.Empty:
+            pass
+         continue
+
+      silences = []
+
+      with phase_timer('windows'):
+         while len(heap) > 0 and heap[0][0] <= datetime.utcnow():
+            due, position, start, day, rule, silence = heapq.heappop(heap)
+
+            silences.append((rule, silence))
+
+            # The next window of the rule, fixed windows only happen once
+            schedule_rule(heap, rule, day, after=start)
+
+         # The windows due at the same time can be merged too
+         silences, merged = merge_silences(silences)
+
+      print("{} Creating {} silences".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), len(silences)))
+
+      # A new snapshot of the silences for each wake up, they can be changed by others meanwhile
+      for backend in backends:
+         backend.index = None
+
+      try:
+         apply_silences(silences, [], merged)
+      except BackendError as e:
+         # The daemon keeps running, the next windows can succeed
+         print("[ERROR] {}".format(e))
+
+      export_metrics()
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Apply a new content of the config in the daemon. Only the rules added, removed or changed
+#              are applied, the unchanged rules keep their scheduled windows
+# Parameters:  Heap of the daemon and files of the config (name, content)
+# Return:      Nothing. If the new config has errors the current one is kept
+
+def reload_conf(heap, sources):
+   global conf
+   global conf_hash
+   global conf_parts
+   global rules
+
+   with phase_timer('config_load'):
+      try:
+         new_conf, new_parts, new_hash = parse_conf(sources)
+      except ConfError as ex:
+         print("[ERROR] Config not reloaded: {}".format(ex))
+         return
+
+      if new_hash == conf_hash:
+         return
+
+      new_rules, errors = compile_rules(new_conf, new_parts)
+
+   if len(errors) > 0:
+      for error in errors:
+         print("[ERROR] {}".format(error))
+      print("[ERROR] Config not reloaded")
+      return
+
+   old_fingerprints = {r.fingerprint: r for r in rules}
+   new_fingerprints = {r.fingerprint: r for r in new_rules}
+
+   added   = [r for r in new_rules if not r.fingerprint in old_fingerprints]
+   removed = [r for r in rules     if not r.fingerprint in new_fingerprints]
+
+   # The windows of the unchanged rules are kept, only the rule is replaced because its
+   # position in the config can be other
+   entries = []
+
+   for due, position, start, day, rule, silence in heap:
+      if rule.fingerprint in new_fingerprints:
+         rule = new_fingerprints[rule.fingerprint]
+         entries.append((due, rule.position, start, day, rule, silence))
+
+   heap[:] = entries
+   heapq.heapify(heap)
+
+   for rule in added:
+      schedule_rule(heap, rule)
+
+   conf       = new_conf
+   conf_hash  = new_hash
+   conf_parts = new_parts
+   rules      = new_rules
+
+   metric_set('silence_alerts_config_bytes', sum([len(content) for name, content in sources]))
+   metric_set('silence_alerts_rules', len(rules))
+
+   print("{} Config reloaded: {} rules added, {} removed, {} unchanged".format(
+         datetime.now().strftime("%Y-%m-%d %H:%M:%S"), len(added), len(removed),
+         len(new_rules) - len(added)))
+
+   for backend in backends:
+      try:
+         expire_rules_silences(backend, removed)
+      except BackendError as e:
+         print("{}: [ERROR] {}".format(backend.name, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Expire the silences not finished yet of the rules removed from the config
+#              The silences are found by author and matchers, so a silence is kept if other rule still uses them
+# Parameters:  Backend and removed rules
+# Return:      Nothing, if any issue raise BackendError
+
+def expire_rules_silences(backend, removed):
+   in_use  = set([(r.author, tuple(sorted(r.matchers))) for r in rules])
+   targets = set([(r.author, tuple(sorted(r.matchers))) for r in removed]) - in_use
+
+   if len(targets) == 0:
+      return
+
+   now     = datetime.utcnow()
+   expired = 0
+
+   for s in (s for filters in silence_filters(removed) for s in backend.query_silences(filters)):
+      if not (s.get('createdBy'), normalize_matchers(s['matchers'])) in targets:
+         continue
+
+      if parse_date(re_date_suffix.sub('', s['endsAt'])) <= now:
+         continue
+
+      backend.expire_silence(s['id'])
+      state_forget(backend, [s['id']])
+      expired += 1
+
+   # The index doesn't have the expired silences anymore
+   backend.index = None
+
+   print("{}: Expired {} silences of removed rules".format(backend.name, expired))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Watch the config file (or the files of the config directory) and send their content when they
+#              change. A ConfigMap mounted as a volume is updated replacing the file, so we check the inode too
+# Parameters:  Queue where the files (name, content) are sent
+# Return:      Nothing, runs forever
+
+def watch_conf_file(updates):
+   last = None
+
+   while True:
+      try:
+         current = []
+
+         for name in conf_files(file_conf):
+            st = os.stat(name)
+            current.append((name, st.st_ino, st.st_mtime, st.st_size))
+
+         if current != last:
+            updates.put(read_conf_sources(file_conf))
+            last = current
+      except (OSError, ConfError) as e:
+         print("[ERROR] Watching {}: {}".format(file_conf, e))
+
+      time.sleep(watch_interval)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Watch the ConfigMap with the config through the Kubernetes API and send its content when it changes
+#              Any error is logged and the watch is started again
+# Parameters:  Queue where the content is sent, ConfigMap (namespace/name) and key of the config in the ConfigMap
+# Return:      Nothing, runs forever
+
+def watch_conf_configmap(updates, configmap, key):
+   namespace, name = configmap.split('/', 1)
+
+   # The watch has its own client, the main thread keeps using the global one
+   api = client.CoreV1Api(client.ApiClient())
+
+   while True:
+      try:
+         for event in watch.Watch().stream(api.list_namespaced_config_map, namespace,
+                                           field_selector='metadata.name={}'.format(name),
+                                           timeout_seconds=300):
+            if event['type'] != 'ADDED' and event['type'] != 'MODIFIED':
+               continue
+
+            data = event['object'].data or {}
+
+            if key in data:
+               updates.put(configmap_sources(key, data[key]))
+            else:
+               print("[ERROR] Key {} not found in ConfigMap {}".format(key, configmap))
+      except Exception as e:
+         print("[ERROR] Exception when watching ConfigMap {}: {}".format(configmap, e))
+         time.sleep(watch_interval)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Files of the config with the content of a key of the ConfigMap. The ConfigMap is the config mounted
+#              in FILE_CONF, so the key has the same name as when it is read from disk: an unchanged content has
+#              the same hash and the other files of a directory are not compiled again
+# Parameters:  Key of the ConfigMap and its content
+# Return:      List of (name, content). If any issue reading the other files raise ConfError
+
+def configmap_sources(key, content):
+   if not os.path.isdir(file_conf):
+      return [(file_conf, content)]
+
+   name = os.path.join(file_conf, key)
+
+   return sorted([source for source in read_conf_sources(file_conf) if source[0] != name] + [(name, content)])
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Push in the heap the next window of a rule which hasn't finished yet, the one which starts first
+#              among all the windows of the rule. The windows are yielded sorted, so the search stops at the
+#              first day with a window after the last one created
+# Parameters:  Heap, rule, first day (date) to look for a window and start of the last window created
+#              Without day it is the day before today in the timezone of the rule, so a window started
+#              yesterday and still in progress is found
+# Return:      Nothing, the rule is not pushed if it hasn't more windows
+
+def schedule_rule(heap, rule, day=None, after=None):
+   now     = datetime.utcnow()
+
+   if day is None:
+      day = pytz.utc.localize(now).astimezone(rule.timezone).date() - timedelta(days=1)
+
+   # Fixed windows only happen once, weekly windows are repeated at least once a week
+   horizon = max([w.horizon(day) for w in rule.windows])
+
+   # The windows of that day are computed even if they are already started
+   for start, end in rule_windows(rule, day, horizon):
+      if end <= now or (after is not None and start <= after):
+         continue
+
+      due = start - timedelta(seconds=daemon_lead_time)
+
+      # The next windows are looked for from the day of this one
+      day = pytz.utc.localize(start).astimezone(rule.timezone).date()
+
+      heapq.heappush(heap, (due, rule.position, start, day, rule, window_silence(rule, start, end)))
+      return
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Create the silences one by one
+# Parameters:  Backend and list of (rule, silence)
+# Return:      Tuple with the rules created, duplicated and failed. If any issue raise BackendError
+
+def create_silences(backend, silences):
+   created    = []
+   pending    = []
+
+   # Before create the silences we check which ones are already created or can be updated
+   writes, duplicates, stale = reconcile_silences(backend, silences)
+
+   for rule, silence in writes:
+      if backend.batch:
+         # The silence is created later with the rest of the batch
+         pending.append((rule, silence))
+         continue
+
+      # Create the silence
+      try:
+         with phase_timer('silence_add', backend.name):
+            silence_id = backend.add_silence(silence)
+      except BackendError:
+         count_results(backend, created, duplicates, [rule])
+         raise
+
+      # The silence is created, so the next alerts of this run must see it
+      register_silence(backend, silence, silence_id)
+      created.append(rule)
+
+   expire_stale_silences(backend, stale)
+
+   if len(pending) == 0:
+      count_results(backend, created, duplicates, [])
+      return created, duplicates, []
+
+   failed = []
+
+   with phase_timer('silence_add', backend.name):
+      results = backend.add_silences([s for r, s in pending])
+
+   for (rule, silence), res in zip(pending, results):
+      if isinstance(res, BackendError):
+         print("[ERROR] {}".format(res))
+         failed.append(rule)
+      else:
+         register_silence(backend, silence, res)
+         created.append(rule)
+
+   count_results(backend, created, duplicates, failed)
+
+   if len(failed) > 0:
+      raise BackendError("{} of {} silences failed".format(len(failed), len(pending)))
+
+   return created, duplicates, []
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Create the silences in parallel with a pool of CONCURRENCY workers
+#              The errors are collected per rule and reported at the end with the rest of results
+# Parameters:  Backend and list of (rule, silence)
+# Return:      Tuple with the rules created, duplicated and failed (rule, error)
+
+def create_silences_concurrently(backend, silences):
+   created    = []
+   failed     = []
+   futures    = {}
+
+   # The duplicate check is done here, so two rules with the same silence
+   # are not created twice by different workers
+   pending, duplicates, stale = reconcile_silences(backend, silences)
+
+   # A batch backend creates several silences per call, so the pending silences
+   # are split in one chunk per worker
+   if backend.batch:
+      chunk_size = max(1, -(-len(pending) // concurrency))
+   else:
+      chunk_size = 1
+
+   with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      for i in range(0, len(pending), chunk_size):
+         chunk = pending[i:i + chunk_size]
+
+         futures[executor.submit(timed_call, 'silence_add', backend.name, backend.add_silences,
+                                 [s for a, s in chunk])] = chunk
+
+      for future in as_completed(futures):
+         chunk = futures[future]
+
+         try:
+            results = future.result()
+         except BackendError as e:
+            results = [e] * len(chunk)
+
+         for (rule, silence), res in zip(chunk, results):
+            if isinstance(res, BackendError):
+               failed.append((rule, res))
+            else:
+               register_silence(backend, silence, res)
+               created.append(rule)
+
+   expire_stale_silences(backend, stale)
+
+   # The workers finish in any order, we report the rules in the order of the config
+   order = {id(rule): i for i, (rule, silence) in enumerate(silences)}
+
+   created.sort(key=lambda rule: order[id(rule)])
+   failed.sort(key=lambda f: order[id(f[0])])
+
+   count_results(backend, created, duplicates, [rule for rule, e in failed])
+
+   return created, duplicates, failed
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Decide what to do with each silence of the run. A silence already created is a duplicate.
+#              Otherwise if there is a silence of the same author and matchers which overlaps, it is updated in
+#              place by id, so the silences don't pile up when a window changes. If not a new one is created.
+#              The rest of silences of the same author and matchers which overlap the run are stale. A silence
+#              which other window of the current rules still needs is never updated nor expired
+# Parameters:  Backend and list of (rule, silence)
+# Return:      Tuple with the list of (rule, silence) to write (with id if it is an update), the duplicated
+#              rules and the ids of the stale silences. If any issue raise BackendError
+
+def reconcile_silences(backend, silences):
+   duplicates = []
+   pending    = []
+   writes     = []
+   claimed    = set()
+   windows    = {}
+   updates    = 0
+
+   # With all the silences in the state there is nothing to write, Alertmanager is not queried
+   if backend.index is None and state_has_silences(backend, silences):
+      return [], [rule for rule, silence in silences], []
+
+   # First the exact matches, so a silence which is already right is never taken by other rule
+   for rule, silence in silences:
+      start, end, matchers = silence_key(silence['startsAt'], silence['endsAt'], silence['matchers'])
+
+      windows.setdefault((silence['createdBy'], matchers), []).append((start, end))
+
+      if check_if_silence_already_exists(backend, silence):
+         claimed.add(backend.index[(start, end, matchers)])
+         state_put(backend, silence, backend.index[(start, end, matchers)])
+         duplicates.append(rule)
+      else:
+         pending.append((rule, silence))
+
+   for rule, silence in pending:
+      # Two rules of this run with the same silence
+      if check_if_silence_already_exists(backend, silence):
+         duplicates.append(rule)
+         continue
+
+      start, end, matchers = silence_key(silence['startsAt'], silence['endsAt'], silence['matchers'])
+
+      group = (silence['createdBy'], matchers)
+
+      for silence_id, s_start, s_end in backend.owned.get(group, []):
+         if not silence_id in claimed and s_start < end and start < s_end and \
+            not silence_needed(group, s_start, s_end, windows[group]):
+            claimed.add(silence_id)
+            backend.index.pop((s_start, s_end, matchers), None)
+
+            silence  = dict(silence, id=silence_id)
+            updates += 1
+            break
+
+      register_silence(backend, silence, None)
+      writes.append((rule, silence))
+
+   stale = []
+
+   for group, group_windows in windows.items():
+      for silence_id, s_start, s_end in backend.owned.get(group, []):
+         if silence_id in claimed:
+            continue
+
+         if any([s_start < end and start < s_end for start, end in group_windows]) and \
+            not silence_needed(group, s_start, s_end, group_windows):
+            claimed.add(silence_id)
+            stale.append(silence_id)
+
+   if updates > 0:
+      print("{}: Updating {} silences in place".format(backend.name, updates))
+
+   return writes, duplicates, stale
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Check if a silence of the script is still needed by other window of the current rules with the
+#              same author and matchers, for example the window in progress of other rule when a rule is due in
+#              the daemon. Those silences can't be updated in place nor expired
+# Parameters:  (author, matchers), start and end of the silence and list of (start, end) of the silences of
+#              the run with the same author and matchers
+# Return:      True if a window not finished which overlaps the silence is not covered by the silences of the run
+
+def silence_needed(group, s_start, s_end, covered):
+   now   = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+   start = parse_date(s_start)
+   days  = min((parse_date(s_end) - start).days + 3, schedule_horizon_days)
+
+   for rule in rules:
+      if (rule.author, tuple(sorted(rule.matchers))) != group:
+         continue
+
+      # The windows which start the day before can be in progress when the silence starts
+      first = pytz.utc.localize(start).astimezone(rule.timezone).date() - timedelta(days=1)
+
+      for w_start, w_end in rule_windows(rule, first, days):
+         w_start = w_start.strftime("%Y-%m-%dT%H:%M:%S")
+         w_end   = w_end.strftime("%Y-%m-%dT%H:%M:%S")
+
+         if w_end <= now or w_end <= s_start or s_end <= w_start:
+            continue
+
+         if not any([c_start <= w_start and w_end <= c_end for c_start, c_end in covered]):
+            return True
+
+   return False
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Expire the stale silences found by reconcile_silences()
+#              A failure is not fatal, the silence is expired in the next run
+# Parameters:  Backend and list of silence ids
+# Return:      Nothing
+
+def expire_stale_silences(backend, stale):
+   if len(stale) == 0:
+      return
+
+   expired = 0
+
+   for silence_id, res in zip(stale, backend.expire_silences(stale)):
+      if isinstance(res, BackendError):
+         print("[ERROR] {}".format(res))
+      else:
+         state_forget(backend, [silence_id])
+         expired += 1
+
+   if expired > 0:
+      print("{}: Expired {} stale silences".format(backend.name, expired))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Print the report of the silences created, duplicated, skipped and failed
+# Parameters:  Lists of rules created, duplicated, skipped and failed (rule, error)
+# Return:      Nothing
+
+def print_report(created, duplicates, skipped, failed):
+   print("Created:   {}".format(len(created)))
+   for rule in created:
+      print("   {}".format(rule.description))
+
+   print("Duplicate: {}".format(len(duplicates)))
+   for rule in duplicates:
+      print("   {}".format(rule.description))
+
+   print("Skipped:   {}".format(len(skipped)))
+   for rule in skipped:
+      print("   {}".format(rule.description))
+
+   print("Failed:    {}".format(len(failed)))
+   for rule, e in failed:
+      print("   {}: {}".format(rule.description, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Make the silence of a rule for a day
+# Parameters:  Rule and day (date). Without day the window of today, see make_window()
+# Return:      Silence, None if the rule doesn't have to be silenced that day
+
+def make_silence(rule, day=None):
+   window = make_window(rule, day)
+
+   if window is None:
+      return None
+
+   return window_silence(rule, window[0], window[1])
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Compute the window of a rule for a day in the timezone of the rule
+#              Without day it is the window of today (current_date in the timezone of the rule), a window
+#              already in progress is kept and a finished one is replaced by the window of tomorrow. With a
+#              day it is the window of that day, even if it is already started, like the daemon does from
+#              the midnight
+# Parameters:  Rule and day (date)
+# Return:      Tuple (start, end) of naive datetimes in UTC, None if the rule doesn't have to be silenced
+
+def make_window(rule, day=None):
+   now    = None
+   window = rule.windows[0]
+
+   if day is None:
+      now = current_date.astimezone(rule.timezone).replace(tzinfo=None)
+      day = now.date()
+
+   if window.kind == 'fixed':
+      start = datetime(*(window.date_start + window.time_start))
+      end   = datetime(*(window.date_end   + window.time_end))
+   else:
+      # Check if that day we have to silence the alert
+      local = window.local_windows(day)
+
+      if len(local) == 0:
+         return None
+
+      start, end = local[0]
+
+   # If the window is finished, take the one of tomorrow. Start and end move together, a window in
+   # progress keeps its start so the silence never starts after it ends
+   if now is not None and end < now:
+      if window.kind == 'fixed':
+         return None
+
+      local = window.local_windows(day + timedelta(days=1))
+
+      if len(local) == 0:
+         return None
+
+      start, end = local[0]
+
+   # Notice: We convert the dates in UTC because Alertmanger uses UTC
+   return local_to_utc(start, rule.timezone), local_to_utc(end, rule.timezone)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Compute the windows of a rule which start in a range of days, in the timezone of the rule
+#              A fixed window is returned once, with the windows of the day it starts, of the first day if it
+#              starts before the range or after the last day if it starts after the range, as the silences can
+#              be created in advance. The windows are yielded sorted by start and a day is computed only when
+#              the windows of the previous one have been consumed
+# Parameters:  Rule, first day (date) and number of days
+# Return:      Generator of (start, end) naive datetimes in UTC
+
+def rule_windows(rule, first_day, days):
+   last_day = first_day + timedelta(days=days - 1)
+   fixed    = [(datetime(*(w.date_start + w.time_start)), datetime(*(w.date_end + w.time_end)))
+               for w in rule.windows if w.kind == 'fixed']
+
+   for offset in range(days):
+      day   = first_day + timedelta(days=offset)
+      local = [(start, end) for start, end in fixed
+               if start.date() == day or (offset == 0 and start.date() < day)]
+
+      for window in rule.windows:
+         if window.kind != 'fixed':
+            local.extend(window.local_windows(day))
+
+      for start, end in sorted(local):
+         yield local_to_utc(start, rule.timezone), local_to_utc(end, rule.timezone)
+
+   for start, end in sorted([(start, end) for start, end in fixed if start.date() > last_day]):
+      yield local_to_utc(start, rule.timezone), local_to_utc(end, rule.timezone)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Get the windows of all the rules for a range of days. The range of each rule starts today in
+#              its timezone. They are kept while the config and the days of the timezones don't change
+# Parameters:  Date of the run (naive local datetime) and number of days
+# Return:      List of (start, end, rule) in UTC sorted by start and position of the rule
+
+def window_index(now, days):
+   global window_index_cache
+
+   today = {zone: now.astimezone(zone).date() for zone in set([rule.timezone for rule in rules])}
+   key   = (conf_hash, id(rules), tuple(sorted([(zone.zone, day) for zone, day in today.items()])), days)
+
+   if window_index_cache is None or window_index_cache[0] != key:
+      intervals          = [(start, end, rule) for rule in rules
+                            for start, end in rule_windows(rule, today[rule.timezone], days)]
+      window_index_cache = (key, sorted(intervals, key=lambda i: (i[0], i[2].position)))
+
+   return window_index_cache[1]
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Make the silence of a rule for a window
+# Parameters:  Rule, start and end (naive datetimes in UTC)
+# Return:      Silence
+
+def window_silence(rule, start, end):
+   # Example date format for amtool: 2019-10-25T22:00:00-00:00
+   return {"matchers":  [{"name": n, "value": v, "isRegex": r} for n, v, r in rule.matchers],
+           "startsAt":  start.strftime("%Y-%m-%dT%H:%M:%S-00:00"),
+           "endsAt":    end.strftime("%Y-%m-%dT%H:%M:%S-00:00"),
+           "createdBy": rule.author,
+           "comment":   rule.comment}
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Send a script to the stdin of an exec session and wait for its end
+# Parameters:  Exec session (WSClient), script (None if the command doesn't read stdin) and deadline
+#              (time.monotonic())
+# Return:      stdout and stderr of the script. If the session fails or doesn't end before the deadline
+#              raise BackendError
+
+def run_script(session, script, deadline):
+   output = []
+
+   try:
+      if script is not None:
+         session.write_stdin(script)
+
+      while session.is_open():
+         if time.monotonic() > deadline:
+            raise BackendError("The exec didn't finish in {} seconds".format(exec_timeout))
+
+         session.update(timeout=1)
+
+         if session.peek_stdout():
+            output.append(session.read_stdout())
+
+         if session.peek_stderr():
+            output.append(session.read_stderr())
+   except (ApiException, OSError, WebSocketException) as e:
+      raise BackendError("Exception reading the output of the exec: {}".format(e))
+   finally:
+      session.close()
+
+   return ''.join(output)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Read the stdout of an exec session while it is received
+# Parameters:  Exec session (WSClient) and deadline (time.monotonic())
+# Return:      Generator of chunks of stdout. The stderr is added at the end, so a decoding error shows it
+#              If the session fails or doesn't end before the deadline raise BackendError
+
+def session_chunks(session, deadline):
+   errors = []
+
+   try:
+      while session.is_open():
+         if time.monotonic() > deadline:
+            raise BackendError("The exec didn't finish in {} seconds".format(exec_timeout))
+
+         session.update(timeout=1)
+
+         if session.peek_stdout():
+            yield session.read_stdout()
+
+         if session.peek_stderr():
+            errors.append(session.read_stderr())
+   except (ApiException, OSError, WebSocketException) as e:
+      raise BackendError("Exception reading the output of the exec: {}".format(e))
+   finally:
+      session.close()
+
+   if len(errors) > 0:
+      yield ''.join(errors)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Decode a JSON array incrementally, element by element, from chunks of text
+#              Only the element being decoded and the pending text are kept in memory
+# Parameters:  Iterable of chunks of text
+# Return:      Generator of the elements of the array. If any issue raise BackendError
+
+def iter_json_array(chunks, target=''):
+   decoder = json.JSONDecoder()
+   chunks  = counted_chunks(chunks, target)
+   buf     = ''
+   pos     = 0
+   started = False
+   elapsed = 0
+
+   while True:
+      while pos < len(buf) and buf[pos] in ' \t\r\n':
+         pos += 1
+
+      # We need more text
+      if pos >= len(buf) - 4 and (not started or pos >= len(buf)):
+         chunk = next(chunks, None)
+
+         if chunk is not None:
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+         if pos >= len(buf):
+            raise BackendError("Unexpected end of the silences JSON")
+
+      if not started:
+         # Go encodes an empty list as null
+         if buf.startswith('null', pos):
+            return
+
+         if buf[pos] != '[':
+            raise BackendError("Silences JSON is not a list: {}".format(buf[pos:pos + 200]))
+
+         started  = True
+         pos     += 1
+         continue
+
+      if buf[pos] == ']':
+         observe_phase('json_decode', elapsed, target)
+         return
+
+      if buf[pos] == ',':
+         pos += 1
+         continue
+
+      try:
+         start        = time.perf_counter()
+         element, pos = decoder.raw_decode(buf, pos)
+         elapsed     += time.perf_counter() - start
+      except JSONDecodeError as e:
+         # The element can be incomplete, we try again with more text
+         chunk = next(chunks, None)
+
+         if chunk is None:
+            raise BackendError("Exception decoding silences JSON: {}: {}".format(e, buf[pos:pos + 200]))
+
+         buf = buf[pos:] + chunk
+         pos = 0
+         continue
+
+      yield element
+
+      # The decoded text is discarded from time to time
+      if pos > 65536:
+         buf = buf[pos:]
+         pos = 0
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Count the characters of the chunks of a silence listing
+# Parameters:  Iterable of chunks of text and name of the target
+# Return:      Generator of the same chunks
+
+def counted_chunks(chunks, target):
+   for chunk in chunks:
+      metric_inc('silence_alerts_query_bytes_total', len(chunk), target=target)
+      yield chunk
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Keep only the fields of a silence used by the script
+# Parameters:  Silence from Alertmanager
+# Return:      Silence with id, dates, author, state and matchers
+
+def slim_silence(j):
+   return {"id":        j.get('id'),
+           "startsAt":  j['startsAt'],
+           "endsAt":    j['endsAt'],
+           "createdBy": j.get('createdBy'),
+           "status":    j.get('status'),
+           "matchers":  [{"name": m['name'], "value": m['value'], "isRegex": m.get('isRegex', False)}
+                         for m in j['matchers']]}
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Check if a pod is running, ready and not terminating
+# Parameters:  Pod
+# Return:      True if is ready, False otherwise
+
+def is_pod_ready(pod):
+   if pod.metadata.deletion_timestamp is not None:
+      return False
+
+   if pod.status is None or pod.status.phase != 'Running':
+      return False
+
+   for condition in pod.status.conditions or []:
+      if condition.type == 'Ready':
+         return condition.status == 'True'
+
+   return False
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Error talking to Alertmanager
+# Parameters:  Message
+# Return:      Nothing
+
+class BackendError(Exception):
+   pass
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Backend which runs amtool inside an Alertmanager pod through kubernetes exec
+# Parameters:  Name of the target, kubernetes client configuration, namespace and label selector of the
+#              Alertmanager pods, batch mode and timeout of the target
+# Return:      Nothing
+
+class AmtoolBackend:
+   def __init__(self, name, configuration, namespace, selector, batch=False, timeout=None):
+      self.name          = name
+      self.configuration = configuration
+      self.namespace     = namespace
+      self.selector      = selector
+      self.batch         = batch
+      self.timeout       = timeout
+      self.index         = None
+      self.owned         = {}
+      self.started       = {}
+      self.api           = client.CoreV1Api(client.ApiClient(configuration))
+      self.pods          = None
+      self.pod           = None
+      self.failed        = set()
+      self.pods_lock     = threading.Lock()
+      self.local         = threading.local()
+
+      # The exec sessions are websockets, without timeout a pod which doesn't answer blocks the connection
+      websocket.setdefaulttimeout(exec_timeout)
+
+   def query_silences(self, filters=()):
+      # We build the command to query the silences, amtool sends the matchers as filters
+      cmd = amtool + ' silence query -o json' + ''.join([' ' + shlex.quote(f) for f in filters])
+
+      if hedge_after > 0:
+         for j in self.hedged_query(cmd):
+            yield j
+         return
+
+      for j in self.retried_query(cmd):
+         yield j
+
+   # Run a silence query, the output is decoded while it is received, silence by silence. A query can be sent
+   # again, so if the pod fails while it answers the query is retried in other pod
+   # Return the list of silences, if all the attempts fail raise BackendError
+   def retried_query(self, cmd):
+      error = None
+
+      for attempt in range(exec_retries):
+         # It raises when it can't connect to any pod after its own attempts
+         chunks = self.exec_command(cmd, stream_output=True)
+
+         try:
+            return [slim_silence(j) for j in iter_json_array(chunks, self.name)]
+         except BackendError as e:
+            error = e
+            print("[ERROR] {}".format(error))
+
+         if attempt < exec_retries - 1:
+            metric_inc('silence_alerts_exec_retries_total', target=self.name)
+            self.get_alertmanager_pod(failed=self.pod)
+
+      raise error
+
+   # Run a silence query in a pod and, if it doesn't answer in hedge_after seconds, in other pod too. The
+   # first answer wins, the slow query finishes in background. A failed query is sent to other pod at once
+   # Return the list of silences, if all the pods fail raise BackendError
+   def hedged_query(self, cmd):
+      results = queue.Queue()
+      started = [self.get_alertmanager_pod()]
+      pending = 1
+      error   = None
+
+      threading.Thread(target=self.query_pod, args=(cmd, started[0], results), daemon=True).start()
+
+      while pending > 0:
+         try:
+            # Only the first query is hedged
+            pod, res = results.get(timeout=hedge_after if len(started) == 1 else None)
+         except queue.Empty:
+            pod, res = None, None
+
+         if pod is not None:
+            pending -= 1
+
+            if not isinstance(res, BackendError):
+               return res
+
+            error = res
+
+         # A slow or failed query is sent to other pod, if there is any left
+         other = self.other_pod(started)
+
+         if other is None:
+            continue
+
+         if pod is None:
+            metric_inc('silence_alerts_hedged_queries_total', target=self.name)
+
+         started.append(other)
+         pending += 1
+
+         threading.Thread(target=self.query_pod, args=(cmd, other, results), daemon=True).start()
+
+      raise error
+
+   # Run a silence query in a pod and put (pod, list of silences or BackendError) in the queue. Any error is
+   # put in the queue, otherwise hedged_query() would wait for the query forever
+   def query_pod(self, cmd, pod, results):
+      try:
+         res = [slim_silence(j) for j in iter_json_array(self.exec_command(cmd, stream_output=True, pod=pod),
+                                                          self.name)]
+      except BackendError as e:
+         res = e
+      except Exception as e:
+         res = BackendError("Unexpected error querying {}: {}: {}".format(pod, type(e).__name__, e))
+
+      results.put((pod, res))
+
+   # A ready pod not used yet by a query, None if all of them are used
+   def other_pod(self, used):
+      with self.pods_lock:
+         candidates = [p for p in self.pods or [] if not p in used]
+
+      return random.choice(candidates) if len(candidates) > 0 else None
+
+   def add_silence(self, silence):
+      # amtool prints the id of the new silence
+      return self.run_amtool(self.add_command(silence))
+
+   def expire_silence(self, silence_id):
+      self.run_amtool(amtool + ' silence expire ' + shlex.quote(silence_id))
+
+   # Run an amtool command and check its exit code. The exec returns stdout and stderr together without
+   # the exit code, so the command prints it after its output between markers, as the batches do
+   # Return the output of the command, if it fails raise BackendError
+   def run_amtool(self, cmd):
+      output = self.exec_command(cmd + ' 2>&1; echo "@@end $?@@"')
+      m      = re.search(r'^(.*?)@@end (\d+)@@\s*$', output, re.DOTALL)
+
+      if m is None:
+         raise BackendError("No output of {}".format(cmd))
+
+      if m.group(2) != '0':
+         raise BackendError("amtool failed: {}".format(m.group(1).strip()))
+
+      return m.group(1).strip()
+
+   def expire_silences(self, silence_ids):
+      # amtool expires several silences per command, the commands are sent in one script to one exec
+      # session. The ids are split in chunks to keep the commands short
+      chunks = [silence_ids[i:i + expire_chunk_size] for i in range(0, len(silence_ids), expire_chunk_size)]
+      script = ''
+
+      for i, chunk in enumerate(chunks):
+         script = script + 'echo "@@begin {}@@"\n'.format(i)
+         script = script + amtool + ' silence expire ' + ' '.join([shlex.quote(s) for s in chunk]) + ' 2>&1\n'
+         script = script + 'echo "@@end {} $?@@"\n'.format(i)
+
+      if len(chunks) == 0:
+         return []
+
+      script  = script + 'exit 0\n'
+      output  = self.exec_command('sh -s', script=script)
+      results = []
+
+      for i, chunk in enumerate(chunks):
+         m = re.search(r'@@begin {0}@@\n(.*?)@@end {0} (\d+)@@'.format(i), output, re.DOTALL)
+
+         if m is None:
+            results.extend([BackendError("No output of amtool silence expire in batch")] * len(chunk))
+         elif m.group(2) != '0':
+            results.extend([BackendError("amtool silence expire failed: {}".format(m.group(1).strip()))] * len(chunk))
+         else:
+            results.extend([None] * len(chunk))
+
+      return results
+
+   def add_silences(self, silences):
+      if not self.batch:
+         return add_silences_one_by_one(self, silences)
+
+      # All the commands are sent in one script to one exec session. Each command is
+      # wrapped between markers to get its output (the id of the silence) and its exit code
+      script = ''
+
+      for i, silence in enumerate(silences):
+         script = script + 'echo "@@begin {}@@"\n'.format(i)
+         script = script + self.add_command(silence) + ' 2>&1\n'
+         script = script + 'echo "@@end {} $?@@"\n'.format(i)
+
+      script  = script + 'exit 0\n'
+      output  = self.exec_command('sh -s', script=script)
+      results = []
+
+      for i, silence in enumerate(silences):
+         m = re.search(r'@@begin {0}@@\n(.*?)@@end {0} (\d+)@@'.format(i), output, re.DOTALL)
+
+         if m is None:
+            results.append(BackendError("No output of amtool silence add in batch: {}".format(
+                                        self.add_command(silence))))
+         elif m.group(2) != '0':
+            results.append(BackendError("amtool silence add failed: {}".format(m.group(1).strip())))
+         else:
+            results.append(m.group(1).strip())
+
+      return results
+
+   def add_command(self, silence):
+      # The matchers of a silence can't change, so an update only sends the dates and the comment
+      # With --quiet amtool prints the id, which is new if Alertmanager can't update it in place
+      if 'id' in silence:
+         cmd = amtool + ' silence update --quiet ' + shlex.quote(silence['id'])
+         cmd = cmd + ' --comment=' + shlex.quote(silence['comment'])
+         cmd = cmd + ' --start='   + silence['startsAt'] + ' --end=' + silence['endsAt']
+
+         return cmd
+
+      cmd = amtool + ' silence add'
+      cmd = cmd + ' --comment=' + shlex.quote(silence['comment'])
+      cmd = cmd + ' --author='  + shlex.quote(silence['createdBy'])
+      cmd = cmd + ' --start='   + silence['startsAt'] + ' --end=' + silence['endsAt']
+
+      for m in silence['matchers']:
+         if m['isRegex']:
+            cmd = cmd + ' ' + shlex.quote('{}=~"{}"'.format(m['name'], m['value']))
+         else:
+            cmd = cmd + ' ' + shlex.quote('{}="{}"'.format(m['name'], m['value']))
+
+      return cmd
+
+   # Run de alert command inside the pod, optionally with a script sent to the stdin of the command
+   # Return the output if OK, with stream_output a generator of chunks of stdout. Otherwise raise
+   # BackendError. With pod the command is run only in that pod
+   # Only the connection is retried: once the session is open the command is running, and sending again an
+   # add could create the silence twice. The session is limited to exec_timeout seconds
+   def exec_command(self, cmd, script=None, stream_output=False, pod=None):
+      stderr    = True 
+      stdin     = True 
+      stdout    = True 
+
+      # Without tty the output is not mangled and the script is not echoed
+      tty       = False
+
+      # We always use the same pod during the run. If the exec fails the pods are discovered again
+      # and we retry in other pod, waiting a random time which grows with each attempt
+      name      = None
+      error     = None
+
+      for attempt in range(1 if pod is not None else exec_retries):
+         if attempt > 0:
+            metric_inc('silence_alerts_exec_retries_total', target=self.name)
+            time.sleep(random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt)))
+
+         try:
+            name = pod if pod is not None else self.get_alertmanager_pod(failed=name)
+         except BackendError as e:
+            error = e
+            print("[ERROR] {}".format(error))
+            continue
+
+         try: 
+            api_response = stream(self.exec_api().connect_get_namespaced_pod_exec,
+                             name, self.namespace, command=['sh', '-c', cmd], stderr=stderr, stdin=stdin, 
+                             stdout=stdout, tty=tty, _preload_content=False)
+         except (ApiException, OSError, WebSocketException) as e:
+            error = BackendError("Exception when calling CoreV1Api->connect_get_namespaced_pod_exec in {}: {}".format(
+                                 name, e))
+            print("[ERROR] {}".format(error))
+            continue
+
+         deadline = time.monotonic() + exec_timeout
+
+         if stream_output:
+            return session_chunks(api_response, deadline)
+
+         return run_script(api_response, script, deadline)
+
+      raise error
+
+   # Kubernetes client used to run exec in the current thread
+   # stream() patches the api client while the exec is running, so each thread needs its own client
+   def exec_api(self):
+      if not hasattr(self.local, 'api'):
+         self.local.api = client.CoreV1Api(client.ApiClient(self.configuration))
+
+      return self.local.api
+
+   # Alertmanager pod used in this run. With a failed pod (or without pods) the pods are discovered again
+   # and other pod is chosen. If any issue raise BackendError
+   def get_alertmanager_pod(self, failed=None):
+      with self.pods_lock:
+         if failed is not None:
+            self.failed.add(failed)
+
+         if failed is not None or self.pods is None:
+            self.pods  = self.get_alertmanager_pods()
+            self.pod   = None
+
+            # We avoid the pods which have failed if there are others
+            candidates = [p for p in self.pods if not p in self.failed]
+
+            if len(candidates) == 0:
+               self.failed = set()
+               candidates  = self.pods
+
+            # We choose a random pod, the same one is used for the rest of the run
+            self.pod = candidates[random.randint(0, len(candidates) - 1)]
+
+         return self.pod
+
+   # List with the ready alertmanager pods. If any issue raise BackendError
+   def get_alertmanager_pods(self):
+      pods = []
+
+      try:
+         with phase_timer('pod_discovery', self.name):
+            ret = self.api.list_namespaced_pod(namespace=self.namespace, label_selector=self.selector,
+                                               watch=False, _request_timeout=exec_timeout)
+
+         for i in ret.items:
+            if is_pod_ready(i):
+               pods.append(i.metadata.name)
+      except (ApiException, urllib3.exceptions.HTTPError) as e:
+         raise BackendError("Exception when calling CoreV1Api->list_namespaced_pod: {}".format(e))
+
+      # Doble check
+      if len(pods) == 0:
+         raise BackendError("Alertmanager Pods not found")
+
+      return pods 
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Backend which talks to the Alertmanager API v2 over HTTP (Service URL or port-forward)
+#              The connections are kept alive in a pool and reused by all the calls of the run
+# Parameters:  Name of the target, Alertmanager URL and timeout of the target
+# Return:      Nothing
+
+class HttpBackend:
+   def __init__(self, name, url, timeout=None):
+      self.name    = name
+      self.batch   = False
+      self.timeout = timeout
+      self.index   = None
+      self.owned   = {}
+      self.started = {}
+      self.url     = url.rstrip('/')
+      self.http    = urllib3.PoolManager(maxsize=http_pool_size, retries=False,
+                                         timeout=urllib3.Timeout(connect=http_timeout, read=http_timeout))
+
+   def request(self, method, path, body=None):
+      headers = {'Accept': 'application/json'}
+
+      if body is not None:
+         body                    = json.dumps(body).encode('utf-8')
+         headers['Content-Type'] = 'application/json'
+
+      try:
+         res = self.http.request(method, self.url + path, body=body, headers=headers)
+      except urllib3.exceptions.HTTPError as e:
+         raise BackendError("Exception when calling Alertmanager {} {}: {}".format(method, path, e))
+
+      if res.status >= 300:
+         raise BackendError("Alertmanager {} {} returned {}: {}".format(
+                            method, path, res.status, res.data.decode('utf-8', 'replace').strip()))
+
+      if len(res.data) == 0:
+         return None
+
+      try:
+         return json.loads(res.data)
+      except JSONDecodeError as e:
+         raise BackendError("Exception json.loads: {}".format(e))
+
+   # Send a request and return a generator of chunks of the response while it is received
+   def stream_request(self, method, path):
+      try:
+         res = self.http.request(method, self.url + path, headers={'Accept': 'application/json'},
+                                 preload_content=False)
+
+         if res.status >= 300:
+            raise BackendError("Alertmanager {} {} returned {}: {}".format(
+                               method, path, res.status, res.read().decode('utf-8', 'replace').strip()))
+
+         decoder = codecs.getincrementaldecoder('utf-8')()
+
+         for chunk in res.stream(65536):
+            yield decoder.decode(chunk)
+
+         res.release_conn()
+      except urllib3.exceptions.HTTPError as e:
+         raise BackendError("Exception when calling Alertmanager {} {}: {}".format(method, path, e))
+
+   def query_silences(self, filters=()):
+      path = '/api/v2/silences'
+
+      if len(filters) > 0:
+         path = path + '?' + urllib.parse.urlencode([('filter', f) for f in filters])
+
+      # amtool only shows active and pending silences, we do the same. The API can't filter by state
+      for j in iter_json_array(self.stream_request('GET', path), self.name):
+         if j['status']['state'] != 'expired':
+            yield slim_silence(j)
+
+   def add_silence(self, silence):
+      return self.request('POST', '/api/v2/silences', api_silence(silence))['silenceID']
+
+   def expire_silence(self, silence_id):
+      self.request('DELETE', '/api/v2/silence/{}'.format(silence_id))
+
+   def expire_silences(self, silence_ids):
+      # The API expires one silence per request, the connections of the pool are reused
+      results = []
+
+      for silence_id in silence_ids:
+         try:
+            results.append(self.expire_silence(silence_id))
+         except BackendError as e:
+            results.append(e)
+
+      return results
+
+   def add_silences(self, silences):
+      # The connections of the pool are reused, so there is no need of batches
+      return add_silences_one_by_one(self, silences)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Create several silences calling add_silence() of the backend for each one
+# Parameters:  Backend and list of silences
+# Return:      List with the id of each silence or the BackendError if it failed
+
+def add_silences_one_by_one(backend, silences):
+   results = []
+
+   for silence in silences:
+      try:
+         results.append(backend.add_silence(silence))
+      except BackendError as e:
+         results.append(e)
+
+   return results
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Convert a silence to the format of the Alertmanager API v2
+# Parameters:  Silence
+# Return:      Silence for the API
+
+def api_silence(silence):
+   res = dict(silence)
+
+   res['startsAt'] = silence['startsAt'].replace('-00:00', 'Z')
+   res['endsAt']   = silence['endsAt'].replace('-00:00', 'Z')
+
+   return res
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Create the backends of the targets section of the config. Without targets there is only
+#              one target, the backend selected in AM_BACKEND
+# Parameters:  None
+# Return:      Nothing. If any issue exists the script
+
+def load_backends():
+   global backends
+
+   targets = conf.get('targets') or []
+   names   = set()
+
+   if len(targets) == 0:
+      if am_backend == 'http':
+         backends = [HttpBackend('default', alertmanager_url, target_timeout)]
+      else:
+         k8s_load_config()
+         backends = [AmtoolBackend('default', client.Configuration.get_default_copy(), am_namespace,
+                                   am_pod_selector, amtool_batch, target_timeout)]
+      return
+
+   backends = []
+
+   for target in targets:
+      if not isinstance(target, dict) or not 'name' in target:
+         print("[ERROR] name not found in target")
+         sys.exit(1)
+
+      name = "{}".format(target['name'])
+
+      if name in names:
+         print("[ERROR] Target {} duplicated".format(name))
+         sys.exit(1)
+
+      names.add(name)
+
+      try:
+         timeout = int(target.get('timeout', target_timeout))
+      except ValueError:
+         print("[ERROR] Target {}: timeout must be a number of seconds".format(name))
+         sys.exit(1)
+
+      if 'url' in target:
+         backends.append(HttpBackend(name, target['url'], timeout))
+      else:
+         backends.append(AmtoolBackend(name, k8s_target_config(name, target.get('context')),
+                                       target.get('namespace', am_namespace),
+                                       target.get('podSelector', am_pod_selector), amtool_batch, timeout))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Load the kubernetes config of a target
+# Parameters:  Name of the target and kubeconfig context, without context the config of K8S_CONNECTION is used
+# Return:      Kubernetes client configuration. If any issue exists the script
+
+def k8s_target_config(name, context):
+   if context is None:
+      if k8s_instance is None:
+         k8s_load_config()
+
+      return client.Configuration.get_default_copy()
+
+   configuration = client.Configuration()
+
+   try:
+      config.load_kube_config(context=context, client_configuration=configuration)
+   except ConfigException as e:
+      print("[ERROR] Target {}: Exception when calling kubernetes config->load_kube_config: {}".format(
+            name, e))
+      sys.exit(1)
+
+   return configuration
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Import the clients of Kubernetes (kubernetes, websocket) and Alertmanager (urllib3), the
+#              thread pool and the metrics server. They are the slowest imports, so the commands which don't
+#              talk to any cluster skip them
+# Parameters:  None
+# Return:      Nothing
+
+def import_clients():
+   global client, config, stream, watch, ApiException, ConfigException, websocket, WebSocketException, urllib3
+   global ThreadPoolExecutor, as_completed, ThreadingHTTPServer, BaseHTTPRequestHandler
+
+   from kubernetes import client, config, stream, watch
+   from kubernetes.client.rest import ApiException
+   from kubernetes.config import ConfigException
+   from websocket import WebSocketException
+   from concurrent.futures import ThreadPoolExecutor, as_completed
+   from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+   import urllib3
+   import websocket
+
+   stream = stream.stream
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Load kubernetes config
+# Parameters:  None
+# Return:      Nothing. If any issue exists the script
+
+def k8s_load_config():
+   global k8s_instance
+
+   if k8s_conn == 'in':
+      try:
+         config.load_incluster_config()
+      except ConfigException as e:
+         print(
+            "[ERROR] Exception when calling kubernetes config->load_incluster_config: {}\n".format(e))
+         sys.exit(1)
+   else:
+      try:
+         config.load_kube_config()
+      except ConfigException as e:
+         print(
+            "[ERROR] Exception when calling kubernetes config->load_kube_config: {}".format(e))
+         sys.exit(1)
+
+   k8s_instance = client.CoreV1Api()
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Check if a silence is already created
+# Parameters:  Backend and silence
+# Return:      True if exists, False otherwise. If any issue exists the script
+
+def check_if_silence_already_exists(backend, silence):
+   # The silences are downloaded only once per run, the rest of checks use the index
+   if backend.index is None:
+      load_silences_index(backend)
+
+   key = silence_key(silence['startsAt'], silence['endsAt'], silence['matchers'])
+
+   if key in backend.index:
+      return True
+
+   # Alertmanager starts at its creation a silence whose start is past, so an active silence with the same end
+   # and matchers which started between the start of the window and now is this one. It is indexed by the start
+   # of the window, so the rest of the run finds it as an exact match
+   now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+
+   for s_start, silence_id in backend.started.get((key[1], key[2]), []):
+      if key[0] <= s_start <= now:
+         backend.index[key] = silence_id
+         return True
+
+   return False
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Download the silences from Alertmanager and build the dedupe index
+# Parameters:  Backend
+# Return:      Nothing. If any issue raise BackendError
+
+def load_silences_index(backend):
+   index   = {}
+   owned   = {}
+   started = {}
+
+   # The silences created by the authors of the rules can be updated or expired by the script
+   authors = set([r.author for r in rules if r.author is not None])
+   start   = time.perf_counter()
+
+   for filters in silence_filters(rules):
+      for j in backend.query_silences(filters):
+         metric_inc('silence_alerts_query_silences_total', target=backend.name)
+         # Optionally the silences created by others are not taken into account
+         if own_silences and not j.get('createdBy') in authors:
+            continue
+
+         key        = silence_key(j['startsAt'], j['endsAt'], j['matchers'])
+         index[key] = j.get('id')
+
+         started.setdefault((key[1], key[2]), []).append((key[0], j.get('id')))
+
+         if j.get('createdBy') in authors:
+            owned.setdefault((j['createdBy'], key[2]), []).append((j.get('id'), key[0], key[1]))
+
+   backend.index   = index
+   backend.owned   = owned
+   backend.started = started
+
+   observe_phase('silence_query', time.perf_counter() - start, backend.name)
+
+   state_reconcile(backend, set(index.values()))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Build the filters sent to Alertmanager to query only the silences which can match the rules
+#              Alertmanager matches the filter against the matchers of the silence as if they were labels, so
+#              we use a regex with the values of a label present in all the rules
+# Parameters:  List of rules
+# Return:      List of queries, each one a list of filters. [[]] queries all the silences
+
+def silence_filters(rule_list):
+   names = None
+
+   for r in rule_list:
+      current = set([m[0] for m in r.matchers])
+      names   = current if names is None else names & current
+
+   if not names:
+      return [[]]
+
+   name    = 'alertname' if 'alertname' in names else sorted(names)[0]
+   values  = sorted(set([m[1] for r in rule_list for m in r.matchers if m[0] == name]))
+
+   queries = []
+   group   = []
+   length  = 0
+
+   for v in values:
+      v = re.escape(v)
+
+      if len(group) > 0 and length + len(v) > filter_max_length:
+         queries.append([regex_filter(name, group)])
+         group  = []
+         length = 0
+
+      group.append(v)
+      length += len(v) + 1
+
+   queries.append([regex_filter(name, group)])
+
+   if len(queries) > filter_max_queries:
+      return [[]]
+
+   return queries
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Build a regex filter in the syntax of Alertmanager matchers
+# Parameters:  Label name and list of escaped regex values
+# Return:      String with the filter
+
+def regex_filter(name, values):
+   value = '|'.join(values).replace('\\', '\\\\').replace('"', '\\"')
+
+   return '{}=~"{}"'.format(name, value)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Add a silence created in this run to the dedupe index
+# Parameters:  Backend, silence and its id
+# Return:      Nothing
+
+def register_silence(backend, silence, silence_id):
+   if backend.index is not None:
+      backend.index[silence_key(silence['startsAt'], silence['endsAt'], silence['matchers'])] = silence_id
+
+   if silence_id is not None:
+      state_put(backend, silence, silence_id)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Open the SQLite state (STATE_DB) and create its tables
+# Parameters:  None
+# Return:      Nothing, if any issue exit the script
+
+def open_state():
+   global state_conn
+
+   try:
+      state_conn = sqlite3.connect(state_db, check_same_thread=False)
+
+      with state_conn:
+         state_conn.execute("CREATE TABLE IF NOT EXISTS silences (target TEXT, key TEXT, silence_id TEXT, "
+                            "ends_at TEXT, PRIMARY KEY (target, key))")
+         state_conn.execute("CREATE INDEX IF NOT EXISTS silences_id ON silences (target, silence_id)")
+         state_conn.execute("CREATE TABLE IF NOT EXISTS targets (target TEXT PRIMARY KEY, reconciled REAL)")
+   except sqlite3.Error as e:
+      print("[ERROR] Opening state {}: {}".format(state_db, e))
+      sys.exit(1)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Build the key of a silence in the state: its author, window and matchers
+# Parameters:  Silence
+# Return:      String
+
+def state_key(silence):
+   return hashlib.sha256(repr((silence['createdBy'], silence_key(silence['startsAt'], silence['endsAt'],
+                                                                 silence['matchers']))).encode('utf-8')).hexdigest()
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Check in the state if all the silences of a run were already created in a target
+#              The state is not used if it wasn't reconciled against Alertmanager in the last interval
+# Parameters:  Backend and list of (rule, silence)
+# Return:      True if all the silences are in the state
+
+def state_has_silences(backend, silences):
+   if state_conn is None:
+      return False
+
+   with state_lock:
+      try:
+         row = state_conn.execute("SELECT reconciled FROM targets WHERE target = ?", (backend.name,)).fetchone()
+
+         if row is None or time.time() - row[0] > state_reconcile_interval:
+            return False
+
+         for rule, silence in silences:
+            if state_conn.execute("SELECT 1 FROM silences WHERE target = ? AND key = ?",
+                                  (backend.name, state_key(silence))).fetchone() is None:
+               metric_inc('silence_alerts_state_lookups_total', target=backend.name, result='miss')
+               return False
+      except sqlite3.Error as e:
+         print("[ERROR] Reading state {}: {}".format(state_db, e))
+         return False
+
+   metric_inc('silence_alerts_state_lookups_total', target=backend.name, result='hit')
+
+   return True
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Save in the state the id of a silence. An update in place keeps the id, so the old window of
+#              the id is removed
+# Parameters:  Backend, silence and its id
+# Return:      Nothing
+
+def state_put(backend, silence, silence_id):
+   if state_conn is None or silence_id is None:
+      return
+
+   with state_lock:
+      try:
+         with state_conn:
+            state_conn.executemany("DELETE FROM silences WHERE target = ? AND silence_id = ?",
+                                   [(backend.name, i) for i in set([silence_id, silence.get('id')]) if i is not None])
+            state_conn.execute("INSERT OR REPLACE INTO silences VALUES (?, ?, ?, ?)",
+                               (backend.name, state_key(silence), silence_id, silence['endsAt']))
+      except sqlite3.Error as e:
+         print("[ERROR] Writing state {}: {}".format(state_db, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Remove from the state the silences expired by the script
+# Parameters:  Backend and list of silence ids
+# Return:      Nothing
+
+def state_forget(backend, silence_ids):
+   if state_conn is None:
+      return
+
+   with state_lock:
+      try:
+         with state_conn:
+            state_conn.executemany("DELETE FROM silences WHERE target = ? AND silence_id = ?",
+                                   [(backend.name, silence_id) for silence_id in silence_ids])
+      except sqlite3.Error as e:
+         print("[ERROR] Writing state {}: {}".format(state_db, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Reconcile the state of a target with the silences of Alertmanager. The silences which are not in
+#              Alertmanager anymore (expired or deleted by others) are removed
+# Parameters:  Backend and set of ids of the silences in Alertmanager
+# Return:      Nothing
+
+def state_reconcile(backend, silence_ids):
+   if state_conn is None:
+      return
+
+   with state_lock:
+      try:
+         with state_conn:
+            rows = state_conn.execute("SELECT silence_id FROM silences WHERE target = ?", (backend.name,)).fetchall()
+
+            state_conn.executemany("DELETE FROM silences WHERE target = ? AND silence_id = ?",
+                                   [(backend.name, r[0]) for r in rows if not r[0] in silence_ids])
+            state_conn.execute("INSERT OR REPLACE INTO targets VALUES (?, ?)", (backend.name, time.time()))
+      except sqlite3.Error as e:
+         print("[ERROR] Writing state {}: {}".format(state_db, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Build the key of a silence in the dedupe index
+# Parameters:  Date start, date end and list of matchers
+# Return:      Tuple with start, end and the normalized matchers
+
+def silence_key(start, end, matchers):
+   return (re_date_suffix.sub('', "{}".format(start)), re_date_suffix.sub('', "{}".format(end)),
+           normalize_matchers(matchers))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Normalize the matchers of a silence, so they can be compared
+# Parameters:  List of matchers
+# Return:      Sorted tuple of (name, value, isRegex)
+
+def normalize_matchers(matchers):
+   normalized = []
+
+   for m in matchers:
+      # isRegex can be a boolean or a string depending on how the JSON was decoded
+      normalized.append(("{}".format(m['name']), "{}".format(m['value']),
+                         "{}".format(m.get('isRegex', False)).lower() == 'true'))
+
+   return tuple(sorted(normalized))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a duration of the command line
+# Parameters:  String with a number and a unit: s, m, h or d
+# Return:      timedelta. If not valid raise argparse.ArgumentTypeError
+
+def parse_duration(string_duration):
+   duration = parse_timedelta(string_duration)
+
+   if duration is None:
+      raise argparse.ArgumentTypeError("not a duration (30m, 12h, 7d): {}".format(string_duration))
+
+   return duration
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a duration: numbers with a unit (s, m, h or d), as 30m, 12h or 1d12h
+# Parameters:  String with the duration
+# Return:      timedelta, None if it is not valid
+
+def parse_timedelta(string_duration):
+   string_duration = "{}".format(string_duration)
+
+   if re.match(r'^(\d+[smhd])+$', string_duration) is None:
+      return None
+
+   units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+   return sum([timedelta(**{units[u]: int(n)}) for n, u in re.findall(r'(\d+)([smhd])', string_duration)],
+              timedelta(0))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Get a timezone. The zones are resolved only once
+# Parameters:  Name of the timezone
+# Return:      pytz timezone, None if it is unknown
+
+def get_timezone(name):
+   if not isinstance(name, str):
+      return None
+
+   if not name in timezones:
+      try:
+         timezones[name] = pytz.timezone("{}".format(name))
+      except pytz.exceptions.UnknownTimeZoneError:
+         timezones[name] = None
+
+   return timezones[name]
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Convert a local time of a timezone to UTC. The DST changes are resolved as Python does with
+#              fold=0: a time repeated when the clock goes back is the first one (DST) and a time skipped when
+#              the clock goes forward is moved forward the length of the gap
+# Parameters:  Naive datetime and timezone
+# Return:      Naive datetime in UTC
+
+def local_to_utc(local, tz):
+   try:
+      d = tz.localize(local, is_dst=None)
+   except pytz.exceptions.AmbiguousTimeError:
+      d = tz.localize(local, is_dst=True)
+   except pytz.exceptions.NonExistentTimeError:
+      d = tz.localize(local, is_dst=False)
+
+   return d.astimezone(pytz.utc).replace(tzinfo=None)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Parse a date in the format used by amtool
+# Parameters:  String with the date
+# Return:      datetime
+
+def parse_date(string_date):
+   return datetime.strptime(string_date.replace('-00:00',''), "%Y-%m-%dT%H:%M:%S")
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Add a value to a metric
+# Parameters:  Name, value and labels
+# Return:      Nothing
+
+def metric_inc(name, value=1, **labels):
+   key = (name, tuple(sorted(labels.items())))
+
+   with metrics_lock:
+      metrics[key] = metrics.get(key, 0) + value
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Set the value of a metric
+# Parameters:  Name, value and labels
+# Return:      Nothing
+
+def metric_set(name, value, **labels):
+   with metrics_lock:
+      metrics[(name, tuple(sorted(labels.items())))] = value
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Add the duration of a phase to its summary
+# Parameters:  Phase, seconds and name of the target ('' if the phase isn't of a target)
+# Return:      Nothing
+
+def observe_phase(phase, seconds, target=''):
+   metric_inc('silence_alerts_phase_seconds_sum', seconds, phase=phase, target=target)
+   metric_inc('silence_alerts_phase_seconds_count', 1, phase=phase, target=target)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Measure the duration of a phase in a with block
+# Parameters:  Phase and name of the target
+# Return:      Context manager
+
+@contextlib.contextmanager
+def phase_timer(phase, target=''):
+   start = time.perf_counter()
+
+   try:
+      yield
+   finally:
+      observe_phase(phase, time.perf_counter() - start, target)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Call a function measuring its duration as a phase, used by the workers of a pool
+# Parameters:  Phase, name of the target, function and its arguments
+# Return:      The result of the function
+
+def timed_call(phase, target, function, *args):
+   with phase_timer(phase, target):
+      return function(*args)
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Count the results of the silences of a target
+# Parameters:  Backend and lists of rules created, duplicated and failed
+# Return:      Nothing
+
+def count_results(backend, created, duplicates, failed):
+   metric_inc('silence_alerts_silences_total', len(created),    target=backend.name, result='created')
+   metric_inc('silence_alerts_silences_total', len(duplicates), target=backend.name, result='duplicate')
+   metric_inc('silence_alerts_silences_total', len(failed),     target=backend.name, result='failed')
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Render the metrics in the Prometheus text format
+# Parameters:  None
+# Return:      String with the metrics
+
+def metrics_text():
+   lines = []
+
+   with metrics_lock:
+      items = sorted(metrics.items())
+
+   for name, kind, description in metrics_help:
+      samples = [(n, labels, v) for (n, labels), v in items if n == name or n in (name + '_sum', name + '_count')]
+
+      if len(samples) == 0:
+         continue
+
+      lines.append("# HELP {} {}".format(name, description))
+      lines.append("# TYPE {} {}".format(name, kind))
+
+      for n, labels, v in samples:
+         values = ','.join(['{}="{}"'.format(k, "{}".format(l).replace('\\', '\\\\').replace('"', '\\"')
+                            .replace('\n', '\\n')) for k, l in labels])
+
+         lines.append("{}{} {}".format(n, '{' + values + '}' if len(values) > 0 else '', repr(float(v))))
+
+   return '\n'.join(lines) + '\n'
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Write the metrics to METRICS_TEXTFILE (node exporter textfile collector) and push them to
+#              PUSHGATEWAY_URL. A failure is only reported, the metrics can't break the silences
+# Parameters:  None
+# Return:      Nothing
+
+def export_metrics():
+   if metrics_textfile is not None:
+      try:
+         # The file is replaced at once, so the collector never reads half a file
+         with open(metrics_textfile + '.tmp', 'w') as stream:
+            stream.write(metrics_text())
+         os.replace(metrics_textfile + '.tmp', metrics_textfile)
+      except OSError as e:
+         print("[ERROR] Writing metrics to {}: {}".format(metrics_textfile, e))
+
+   if pushgateway_url is not None:
+      url = "{}/metrics/job/{}".format(pushgateway_url.rstrip('/'), metrics_job)
+
+      try:
+         res = urllib3.PoolManager(retries=False, timeout=http_timeout).request(
+               'PUT', url, body=metrics_text().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+         if res.status >= 300:
+            print("[ERROR] Pushing metrics to {} returned {}".format(url, res.status))
+      except urllib3.exceptions.HTTPError as e:
+         print("[ERROR] Pushing metrics to {}: {}".format(url, e))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Serve the metrics in /metrics from a thread
+# Parameters:  Port
+# Return:      Nothing
+
+def start_metrics_server(port):
+   class MetricsHandler(BaseHTTPRequestHandler):
+      def log_message(self, format, *args):
+         pass
+
+      def do_GET(self):
+         if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+         body = metrics_text().encode('utf-8')
+
+         self.send_response(200)
+         self.send_header('Content-Type', 'text/plain; version=0.0.4')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+   server = ThreadingHTTPServer(('', port), MetricsHandler)
+
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+
+   print("Metrics served in :{}/metrics".format(port))
+#==================================================================================================================
+
+#==================================================================================================================
+# Description: Print process duration
+# Parameters:  None
+# Return:      Nothing
+
+def print_duration():
+   print("Duration: {:0.4f} seconds".format(timeit.default_timer() - process_init_time))
+#==================================================================================================================
+
+# Main
+#******************************************************************************************************************
+if __name__ == '__main__':
+   # Capture signals
+   signal.signal(signal.SIGTERM, signal_handler)
+   signal.signal(signal.SIGINT,  signal_handler)
+
+   parser      = argparse.ArgumentParser(description='Silence alerts in Alertmanager')
+   subparsers  = parser.add_subparsers(dest='command')
+
+   run_args    = subparsers.add_parser('run',  help='Create the silences of today and exit (default)')
+   run_args.add_argument('--lookahead-days', type=int, metavar='N',
+                         help='Create the silences of the next N days, today included')
+   plan_args   = subparsers.add_parser('plan', help='Print the silences of today without creating them')
+   plan_args.add_argument('--lookahead-days', type=int, metavar='N',
+                          help='Print the silences of the next N days, today included')
+   daemon_args = subparsers.add_parser('daemon', help='Keep running and create each silence just before its window')
+   daemon_args.add_argument('--watch', action='store_true',
+                            help='Reload the config when the file changes')
+   daemon_args.add_argument('--configmap', metavar='NAMESPACE/NAME',
+                            help='Reload the config when this ConfigMap changes (Kubernetes API)')
+   daemon_args.add_argument('--configmap-key', default='silence-alerts.yaml',
+                            help='Key of the config in the ConfigMap (default silence-alerts.yaml)')
+   daemon_args.add_argument('--metrics-port', type=int,
+                            help='Serve the Prometheus metrics in this port (/metrics)')
+   gc_args     = subparsers.add_parser('gc', help='Expire the silences of global.author which no alert uses')
+   gc_args.add_argument('--max-age', type=parse_duration, metavar='DURATION',
+                        help='Expire also the silences started more than this ago which no window needs (30m, 12h, 7d)')
+   gc_args.add_argument('--dry-run', action='store_true',
+                        help='Print the silences without expiring them')
+   validate_args = subparsers.add_parser('validate', help='Check the config and report all its errors, '
+                                                          'without connecting to any cluster')
+   validate_args.add_argument('path', nargs='?',
+                              help='Config file or directory to check (default FILE_CONF)')
+
+   args        = parser.parse_args()
+
+   if getattr(args, 'lookahead_days', None) is not None and args.lookahead_days < 1:
+      print("[ERROR] --lookahead-days must be a positive number")
+      sys.exit(1)
+
+   base_path = os.path.dirname( os.path.realpath(__file__) )
+   base_path = base_path.replace('/scripts','')
+
+   default_file_conf = "{}/conf/silence-alerts.yaml".format(base_path)
+
+   file_conf = os.environ.get('FILE_CONF')
+
+   if file_conf == None:
+      file_conf = default_file_conf
+
+   # validate runs offline and only reads the config: the settings of the backends are not checked and
+   # neither the duration nor the metrics are printed
+   if args.command == 'validate':
+      if args.path is not None:
+         file_conf = args.path
+
+      main(args)
+      sys.exit(0)
+
+   # Register the function which print the duration of the process
+   atexit.register(print_duration)
+
+   # The metrics are exported at the exit, whatever the result
+   import_clients()
+   atexit.register(export_metrics)
+
+   # Prometheus textfile and Pushgateway where the metrics are exported
+   metrics_textfile = os.environ.get('METRICS_TEXTFILE')
+   pushgateway_url  = os.environ.get('PUSHGATEWAY_URL')
+   k8s_conn  = os.environ.get('K8S_CONNECTION', k8s_conn_default)
+
+   # Backend used to talk to Alertmanager: exec (amtool inside a pod) or http (API v2)
+   am_backend       = os.environ.get('AM_BACKEND', am_backend_default)
+   alertmanager_url = os.environ.get('ALERTMANAGER_URL', alertmanager_url_default)
+
+   # Number of silences created in parallel, 1 creates them one by one
+   concurrency      = os.environ.get('CONCURRENCY', concurrency_default)
+
+   # Send all the amtool silence add commands in one exec session
+   amtool_batch     = os.environ.get('AMTOOL_BATCH', amtool_batch_default).lower()
+
+   # Only the silences created by the authors of the rules are used to find duplicates
+   own_silences     = os.environ.get('OWN_SILENCES', own_silences_default).lower()
+
+   # Merge the silences of the rules with the same matchers and overlapping windows
+   merge_enabled    = os.environ.get('MERGE_SILENCES', merge_silences_default).lower()
+
+   # Seconds to apply the silences in a target
+   target_timeout   = os.environ.get('TARGET_TIMEOUT', target_timeout_default)
+
+   # SQLite file with the silences created, and seconds between reconciliations against Alertmanager
+   state_db                 = os.environ.get('STATE_DB')
+   state_reconcile_interval = os.environ.get('STATE_RECONCILE_INTERVAL', state_reconcile_interval_default)
+
+   # Seconds before the window when the daemon creates the silence
+   daemon_lead_time = os.environ.get('DAEMON_LEAD_TIME', daemon_lead_time_default)
+
+   # Pods where amtool is run by the exec backend
+   am_pod_selector  = os.environ.get('AM_POD_SELECTOR', am_pod_selector)
+
+   # Attempts of each exec call and seconds to connect, and seconds before a silence query is hedged
+   exec_retries     = os.environ.get('EXEC_RETRIES', exec_retries_default)
+   exec_timeout     = os.environ.get('EXEC_TIMEOUT', exec_timeout_default)
+   hedge_after      = os.environ.get('HEDGE_AFTER', hedge_after_default)
+
+   if k8s_conn != 'in' and k8s_conn != 'out':
+      print("[ERROR] Kubernetes connection unknown: {}".format(k8s_conn))
+      sys.exit(1)
+
+   if am_backend != 'exec' and am_backend != 'http':
+      print("[ERROR] Alertmanager backend unknown: {}".format(am_backend))
+      sys.exit(1)
+
+   if amtool_batch != 'true' and amtool_batch != 'false':
+      print("[ERROR] AMTOOL_BATCH must be true or false: {}".format(amtool_batch))
+      sys.exit(1)
+
+   amtool_batch = amtool_batch == 'true'
+
+   if own_silences != 'true' and own_silences != 'false':
+      print("[ERROR] OWN_SILENCES must be true or false: {}".format(own_silences))
+      sys.exit(1)
+
+   own_silences = own_silences == 'true'
+
+   if merge_enabled != 'true' and merge_enabled != 'false':
+      print("[ERROR] MERGE_SILENCES must be true or false: {}".format(merge_enabled))
+      sys.exit(1)
+
+   merge_enabled = merge_enabled == 'true'
+
+   try:
+      concurrency = int(concurrency)
+   except ValueError:
+      concurrency = 0
+
+   if concurrency < 1:
+      print("[ERROR] CONCURRENCY must be a positive number")
+      sys.exit(1)
+
+   try:
+      target_timeout = int(target_timeout)
+   except ValueError:
+      print("[ERROR] TARGET_TIMEOUT must be a number of seconds")
+      sys.exit(1)
+
+   try:
+      exec_retries = int(exec_retries)
+   except ValueError:
+      exec_retries = 0
+
+   if exec_retries < 1:
+      print("[ERROR] EXEC_RETRIES must be a positive number")
+      sys.exit(1)
+
+   try:
+      exec_timeout = int(exec_timeout)
+   except ValueError:
+      print("[ERROR] EXEC_TIMEOUT must be a number of seconds")
+      sys.exit(1)
+
+   try:
+      hedge_after = float(hedge_after)
+   except ValueError:
+      print("[ERROR] HEDGE_AFTER must be a number of seconds")
+      sys.exit(1)
+
+   try:
+      state_reconcile_interval = int(state_reconcile_interval)
+   except ValueError:
+      print("[ERROR] STATE_RECONCILE_INTERVAL must be a number of seconds")
+      sys.exit(1)
+
+   try:
+      daemon_lead_time = int(daemon_lead_time)
+   except ValueError:
+      print("[ERROR] DAEMON_LEAD_TIME must be a number of seconds")
+      sys.exit(1)
+
+   if args.command == 'daemon' and args.configmap is not None and not '/' in args.configmap:
+      print("[ERROR] ConfigMap must be NAMESPACE/NAME: {}".format(args.configmap))
       sys.exit(1)
 
-   main()
+   main(args)
 #******************************************************************************************************************